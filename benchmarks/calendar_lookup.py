@@ -0,0 +1,56 @@
+"""
+Compara as consultas do TarponCalendar pré-calculado (searchsorted nos
+arrays de dias úteis) com os offsets CustomBusinessDay/MonthEnd do pandas.
+
+Uso:
+    python -m benchmarks.calendar_lookup [--calls 20000]
+"""
+
+import argparse
+import datetime
+import random
+import time
+
+from src.calendar import TarponCalendar
+
+
+def timed(function, dates):
+    start = time.perf_counter()
+    results = [function(date) for date in dates]
+    return results, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=20_000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    calendar = TarponCalendar()
+    build = time.perf_counter() - start
+
+    rng = random.Random(7)
+    dates = [
+        datetime.date(2006, 1, 1) + datetime.timedelta(days=rng.randint(0, 7300))
+        for _ in range(args.calls)
+    ]
+    lookups = [
+        ("dia útil anterior", calendar.get_previous_trading_day,
+         lambda d: d - calendar.custom_calendar_day),
+        ("último dia do mês", calendar.get_last_trading_day_of_month,
+         lambda d: d + calendar.custom_calendar_month_end),
+        ("primeiro dia do mês", calendar.get_first_trading_day_of_month,
+         lambda d: d - calendar.custom_calendar_month_begin),
+    ]
+
+    print(f"Calendário montado em {build * 1e3:.1f} ms; {args.calls} consultas por método")
+    print(f"{'consulta':<22}{'offsets (µs)':>14}{'arrays (µs)':>14}")
+    for name, lookup, offset in lookups:
+        expected, old = timed(offset, dates)
+        got, new = timed(lookup, dates)
+        assert got == expected, name
+        print(f"{name:<22}{old / args.calls * 1e6:>14.2f}{new / args.calls * 1e6:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Mede o tempo de partida do manage.py: o --help e, para cada comando, a
+resolução do comando com a importação do módulo do job (sem executá-lo).
+
+Cada medida roda num processo novo, como numa chamada real do cron.
+
+Uso:
+    python -m benchmarks.cli_startup [--repeat 5]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+from manage import JOB_COMMANDS
+
+# Importa só o que o comando importaria ao rodar
+RESOLVE = (
+    "import importlib, manage; "
+    "module, _ = manage.JOB_COMMANDS[{name!r}]; "
+    "importlib.import_module(module)"
+)
+
+
+def timed(args, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], check=True, capture_output=True)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    baseline = timed(["-c", "pass"], args.repeat)
+    rows = [("python (vazio)", baseline), ("--help", timed(["manage.py", "--help"], args.repeat))]
+    for name in JOB_COMMANDS:
+        rows.append((name, timed(["-c", RESOLVE.format(name=name)], args.repeat)))
+
+    print(f"Mediana de {args.repeat} execuções por comando")
+    print(f"{'comando':<22}{'tempo (s)':>12}{'sem o python (s)':>18}")
+    for name, seconds in rows:
+        print(f"{name:<22}{seconds:>12.3f}{seconds - baseline:>18.3f}")
+
+
+if __name__ == "__main__":
+    main()
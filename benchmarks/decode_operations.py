@@ -0,0 +1,110 @@
+"""
+Compara o caminho antigo de decodificação de operações (response.json() ->
+pd.DataFrame -> conversões coluna a coluna) com o do cliente (src.decoding.loads
+-> extract_items -> records_to_frame).
+
+Uso:
+    python -m benchmarks.decode_operations [--page pagina.json[.gz]] [--rows 10000]
+
+Sem --page, gera uma página sintética com os campos usados por trades_tpe e
+mais 40 campos descartados.
+"""
+
+import argparse
+import gzip
+import json
+import random
+import statistics
+import time
+import tracemalloc
+
+import pandas as pd
+
+from src.decoding import loads, orjson, records_to_frame
+from src.maravi import extract_items
+from src.trades_tpe import OPERATION_SCHEMA
+
+UNUSED_FIELDS = 40
+
+
+def synthetic_page(rows):
+    rng = random.Random(42)
+    objects = {}
+    for i in range(rows):
+        record = {}
+        for column, kind in OPERATION_SCHEMA.items():
+            if kind == "numeric":
+                record[column] = round(rng.uniform(-1e6, 1e6), 4)
+            elif kind == "datetime":
+                record[column] = f"2025-08-{rng.randint(1, 28):02d}"
+            elif kind == "Int64":
+                record[column] = rng.choice([rng.randint(1, 5000), None])
+            else:
+                record[column] = f"{column}-{rng.randint(1, 500)}"
+        record["id"] = str(i)
+        for j in range(UNUSED_FIELDS):
+            record[f"unused_field_{j}"] = {"value": j, "label": f"x{j}"} if j % 5 == 0 else f"v{j}"
+        objects[str(i)] = record
+    return json.dumps({"objects": objects}).encode()
+
+
+def old_path(body):
+    result = json.loads(body)
+    df = pd.DataFrame(list(result["objects"].values()))
+    df = df[[col for col in OPERATION_SCHEMA if col in df.columns]].copy()
+    for column, kind in OPERATION_SCHEMA.items():
+        if kind == "numeric":
+            df[column] = pd.to_numeric(df[column], errors="coerce")
+        elif kind == "datetime":
+            df[column] = pd.to_datetime(df[column], errors="coerce")
+        elif kind == "Int64":
+            df[column] = df[column].astype("Int64")
+    return df
+
+
+def new_path(body):
+    return records_to_frame(extract_items(loads(body), "objects"), OPERATION_SCHEMA)
+
+
+def measure(fn, body, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(body)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    df = fn(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(timings), peak, df
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--page", help="Página de operations/operations/get gravada (JSON, opcionalmente .gz)")
+    parser.add_argument("--rows", type=int, default=10000, help="Linhas da página sintética")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.page:
+        with open(args.page, "rb") as f:
+            body = f.read()
+        if body[:2] == b"\x1f\x8b":
+            body = gzip.decompress(body)
+    else:
+        body = synthetic_page(args.rows)
+
+    print(f"Página: {len(body) / 1e6:.1f} MB | parser rápido: {'orjson' if orjson else 'indisponível (json)'}")
+    old_time, old_peak, old_df = measure(old_path, body, args.repeats)
+    new_time, new_peak, new_df = measure(new_path, body, args.repeats)
+
+    pd.testing.assert_frame_equal(old_df.reset_index(drop=True), new_df)
+    print(f"{'caminho':<10}{'tempo (s)':>12}{'pico (MB)':>12}")
+    print(f"{'antigo':<10}{old_time:>12.3f}{old_peak / 1e6:>12.1f}")
+    print(f"{'colunar':<10}{new_time:>12.3f}{new_peak / 1e6:>12.1f}")
+    print(f"Ganho: {old_time / new_time:.1f}x tempo, {old_peak / new_peak:.1f}x memória")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Compara a de-duplicação antiga de liabilities/position/get (chaves em string
+num set) com o HashIndex de 64 bits de src.dedup numa carga de fim de mês.
+
+Uso:
+    python -m benchmarks.dedup_index [--rows 100000] [--per-page 1000] [--dup-rate 0.05]
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from src.api2 import MaraviAPI
+from src.dedup import HashIndex, hash_records
+
+
+def synthetic_pages(rows, per_page, dup_rate):
+    rng = random.Random(7)
+    records = []
+    for i in range(rows):
+        if records and rng.random() < dup_rate:
+            records.append(dict(rng.choice(records)))  # Registro repetido entre páginas
+            continue
+        records.append(
+            {
+                "portfolio_name": f"FUNDO {rng.randint(1, 46)}",
+                "date": "2025-08-29",
+                "investor_names": [f"INVESTIDOR {i}"],
+                "investor_ids": [i],
+                "distributor_name": f"DIST {rng.randint(1, 30)}",
+                "account_group_names": [f"GRUPO {rng.randint(1, 10)}"],
+                "shares_amount": round(rng.uniform(1, 1e6), 8),
+                "financial_value": round(rng.uniform(1, 1e7), 2),
+                "participation_in_portfolio": rng.random(),
+            }
+        )
+    return [records[i : i + per_page] for i in range(0, rows, per_page)]
+
+
+def old_identifier(item):
+    key_parts = []
+    for key in MaraviAPI.identifier_fields:
+        if key in item:
+            key_parts.append(f"{key}:{item[key]}")
+    if not key_parts:
+        return str(sorted(item.items()))
+    return "|".join(key_parts)
+
+
+def old_dedup(pages):
+    processed_items, kept = set(), 0
+    for items in pages:
+        for item in items:
+            item_id = old_identifier(item)
+            if item_id not in processed_items:
+                processed_items.add(item_id)
+                kept += 1
+    return kept, processed_items
+
+
+def new_dedup(pages):
+    index, kept = HashIndex(), 0
+    for items in pages:
+        kept += int(index.add(hash_records(items, MaraviAPI.identifier_fields)).sum())
+    return kept, index
+
+
+def measure(fn, pages):
+    start = time.process_time()
+    kept, index = fn(pages)
+    cpu = time.process_time() - start
+
+    tracemalloc.start()
+    _, retained = fn(pages)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del retained
+    return kept, cpu, current
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--per-page", type=int, default=1000)
+    parser.add_argument("--dup-rate", type=float, default=0.05)
+    args = parser.parse_args()
+
+    pages = synthetic_pages(args.rows, args.per_page, args.dup_rate)
+    old_kept, old_cpu, old_mem = measure(old_dedup, pages)
+    new_kept, new_cpu, new_mem = measure(new_dedup, pages)
+    assert old_kept == new_kept, (old_kept, new_kept)
+
+    print(f"{args.rows} linhas em {len(pages)} páginas, {new_kept} únicas")
+    print(f"{'índice':<10}{'CPU (s)':>10}{'memória retida (MB)':>22}")
+    print(f"{'set[str]':<10}{old_cpu:>10.3f}{old_mem / 1e6:>22.2f}")
+    print(f"{'uint64':<10}{new_cpu:>10.3f}{new_mem / 1e6:>22.2f}")
+    print(
+        f"Economia: {old_cpu - new_cpu:.3f} s de CPU ({old_cpu / new_cpu:.1f}x), "
+        f"{(old_mem - new_mem) / 1e6:.2f} MB ({old_mem / max(new_mem, 1):.0f}x)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Compara um backfill sequencial (busca, trata e grava cada data antes da
+próxima) com os estágios de src.pipeline, simulando a latência da API e do banco.
+
+Uso:
+    python -m benchmarks.pipeline_overlap [--dates 20] [--fetch-ms 200] [--load-ms 150] [--fetchers 1] [--depth 2]
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.pipeline import run_pipeline
+
+
+def fake_fetch(fetch_ms, rows):
+    def fetch(date):
+        time.sleep(fetch_ms / 1000)  # Espera de rede: libera o GIL
+        return pd.DataFrame({"date": date, "value": np.arange(rows, dtype=float)})
+    return fetch
+
+
+def transform(date, df):
+    return df.assign(value=df["value"] * 2)
+
+
+def fake_load(load_ms):
+    def load(date, df):
+        time.sleep(load_ms / 1000)  # Espera do Postgres
+        return len(df)
+    return load
+
+
+def sequential(dates, fetch, load):
+    rows = 0
+    for date in dates:
+        rows += load(date, transform(date, fetch(date)))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--dates", type=int, default=20)
+    parser.add_argument("--fetch-ms", type=float, default=200)
+    parser.add_argument("--load-ms", type=float, default=150)
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--fetchers", type=int, default=1)
+    parser.add_argument("--depth", type=int, default=2)
+    args = parser.parse_args()
+
+    dates = list(pd.bdate_range("2025-01-02", periods=args.dates))
+    fetch, load = fake_fetch(args.fetch_ms, args.rows), fake_load(args.load_ms)
+
+    start = time.perf_counter()
+    old_rows = sequential(dates, fetch, load)
+    old = time.perf_counter() - start
+
+    start = time.perf_counter()
+    report = run_pipeline(
+        dates, fetch, load, transform=transform,
+        fetchers=args.fetchers, depth=args.depth, label="benchmark",
+    )
+    new = time.perf_counter() - start
+    assert report.rows == old_rows and not report.failed
+
+    print(f"{args.dates} datas, busca {args.fetch_ms:.0f} ms, gravação {args.load_ms:.0f} ms")
+    print(f"{'modo':<12}{'tempo (s)':>10}")
+    print(f"{'sequencial':<12}{old:>10.2f}")
+    print(f"{'pipeline':<12}{new:>10.2f}")
+    print(f"Ganho: {old / new:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,74 +1,112 @@
-import click
-from src import movimentos
-from src import precos
-from src import plfund
-from src import positions
-from src import trades_tpe
-from src import portfolio
-
-
-@click.group()
-def cli():
-    pass
-
-
-@cli.command()
-def movimentacao():
-    movimentos.run()
-
-
-@cli.command()
-def prices():
-    precos.run()
-
-
-@cli.command()
-def prices_range():
-    precos.batch()
-
-
-@cli.command()
-def movimentacao_batch():
-    movimentos.batch()
-
-
-@cli.command()
-def pls():
-    plfund.run()
-
-
-@cli.command()
-def pls_batch():
-    plfund.batch()
-
+import importlib
+import os
 
-@cli.command()
-def posicao():
-    positions.run()
-
-
-@cli.command()
-def posicao_batch():
-    positions.batch()
-
-
-@cli.command()
-def operations():
-    trades_tpe.run()
-
-
-@cli.command()
-def operations_batch():
-    trades_tpe.batch()
+import click
+from src.response_cache import MODES, OFF
+
+# Comandos dos jobs: nome -> (módulo, função). O módulo só é importado
+# quando o comando roda, para o --help e os outros comandos não pagarem
+# pelo pandas, SQLAlchemy e cliente da API de todos os jobs.
+JOB_COMMANDS = {
+    "movimentacao": ("src.movimentos", "run"),
+    # prices e pls diários vão pela busca conjunta de src.pricing: o primeiro
+    # grava os dois jobs e o outro já os encontra concluídos no run_ledger
+    "prices": ("src.pricing", "run"),
+    "prices-range": ("src.precos", "batch"),
+    "prices-pls": ("src.pricing", "run"),
+    "prices-pls-batch": ("src.pricing", "batch"),
+    "movimentacao-batch": ("src.movimentos", "batch"),
+    "pls": ("src.pricing", "run"),
+    "pls-batch": ("src.plfund", "batch"),
+    "posicao": ("src.positions", "run"),
+    "posicao-batch": ("src.positions", "batch"),
+    "operations": ("src.trades_tpe", "run"),
+    "operations-batch": ("src.trades_tpe", "batch"),
+    "carteiras": ("src.portfolio", "run"),
+    "carteiras-batch": ("src.portfolio", "batch"),
+}
+
+DATE = click.DateTime(formats=["%Y-%m-%d"])
+
+
+class LazyGroup(click.Group):
+    """Grupo que importa o módulo de um job só quando o comando é chamado."""
+
+    def __init__(self, *args, lazy_commands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.lazy_commands:
+            return super().get_command(ctx, cmd_name)
+
+        module_name, function_name = self.lazy_commands[cmd_name]
+        params = [
+            click.Option(
+                ["--force"],
+                is_flag=True,
+                help="Refaz as datas já concluídas no run_ledger.",
+            )
+        ]
+        if function_name == "batch":
+            # Sem --start, começa na primeira data gravada; sem --end, vai até o último dia útil
+            params += [
+                click.Option(["--start"], type=DATE, help="Primeira data do backfill (AAAA-MM-DD)."),
+                click.Option(["--end"], type=DATE, help="Última data do backfill (AAAA-MM-DD)."),
+            ]
+
+        def callback(force, **dates):
+            module = importlib.import_module(module_name)
+            kwargs = {name: value.date() for name, value in dates.items() if value is not None}
+            getattr(module, function_name)(force=force, **kwargs)
+
+        return click.Command(
+            cmd_name,
+            callback=callback,
+            params=params,
+            help=f"Executa {module_name}.{function_name}().",
+        )
+
+
+@click.group(cls=LazyGroup, lazy_commands=JOB_COMMANDS)
+@click.option(
+    "--cache-mode",
+    type=click.Choice(MODES),
+    default=OFF,
+    envvar="MARAVI_CACHE_MODE",
+    show_default=True,
+    help="Cache de respostas da API: use, record ou replay (offline, só do cache).",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    envvar="BACKFILL_WORKERS",
+    help="Buscas simultâneas na API dos comandos *-batch (padrão: 4).",
+)
+@click.option(
+    "--queue-depth",
+    type=click.IntRange(min=1),
+    envvar="PIPELINE_DEPTH",
+    help="Lotes prontos em cada fila entre busca, tratamento e gravação nos comandos *-batch (padrão: 2).",
+)
+def cli(cache_mode, workers, queue_depth):
+    os.environ["MARAVI_CACHE_MODE"] = cache_mode
+    if workers:
+        os.environ["BACKFILL_WORKERS"] = str(workers)
+    if queue_depth:
+        os.environ["PIPELINE_DEPTH"] = str(queue_depth)
 
 
 @cli.command()
-def carteiras():
-    portfolio.run()
+@click.option("--partition", is_flag=True, help="Converte positions, operations e fund_portfolio em tabelas particionadas por mês.")
+def migrate(partition):
+    """Cria chaves e índices nas tabelas existentes."""
+    from src import schema
 
-@cli.command()
-def carteiras_batch():
-    portfolio.batch()
+    schema.migrate(partition=partition)
 
 
 if __name__ == "__main__":
@@ -1,135 +1,71 @@
 import pandas as pd
 import requests
-import logging
 
+from src.decoding import records_to_frame
+from src.maravi import BaseMaraviAPI
+from src.response_cache import CacheMissError
+from src.throttle import TransientAPIError
 
-class MaraviAPI:
-    def __init__(self, username, password, client_id, client_secret):
-        self.base_url = "https://tarpon.bluedeck.com.br/api"
-        self.username = username
-        self.password = password
-        self.client_id = client_id
-        self.client_secret = client_secret
-        self.credentials = None
-        self.logger = logging.getLogger("MaraviAPI")
-
-    def authenticate(self):
-        url = f"{self.base_url}/auth/token"
-        data = {
-            "username": self.username,
-            "password": self.password,
-        }
-        client_headers = {
-            "CF-Access-Client-Id": self.client_id,
-            "CF-Access-Client-Secret": self.client_secret,
-        }
-        
-        try:
-            response = requests.post(url, data=data, headers=client_headers)
-            response.raise_for_status()
-            token_json_response = response.json()
-            token_header = {
-                "Authorization": f"{token_json_response['token_type']} {token_json_response['access_token']}"
-            }
-            credentials = {**client_headers, **token_header}
-            self.credentials = credentials
-        except requests.exceptions.RequestException as e:
-            self.logger.error(f"Authentication failed: {str(e)}")
-            raise
-
-    def fetch_data(self, endpoint, params=None):
-        url = f"{self.base_url}/{endpoint}"
 
+class MaraviAPI(BaseMaraviAPI):
+    def fetch_data(self, endpoint, params=None, schema=None):
         if not self.credentials:
             self.logger.warning("No credentials available. Attempting to authenticate...")
             try:
                 self.authenticate()
             except Exception as e:
                 self.logger.error(f"Authentication failed: {str(e)}")
-                return pd.DataFrame()  # Return empty DataFrame on auth failure
-
-        all_data = []
-        page = 0
-        if params is None:
-            params = {}
-            
-        # Create a copy of params to avoid modifying the original
-        request_params = params.copy()
-        request_params["pagination"] = {
-            "per_page": 10000,  # Número de itens por página
-            "page": 0,  # Página inicial
-        }
+                raise
 
         # For debugging
         self.logger.info(f"Starting API requests to {endpoint}")
-        
+
         try:
-            # Make the first request outside the loop to check the structure
-            response = requests.post(url, headers=self.credentials, json=request_params)
-            response.raise_for_status()
-            result = response.json()
-            
+            # Page size is fixed for the whole fetch so pages line up
+            per_page = self.page_size(endpoint)
+
+            # Make the first request on its own to check the structure
+            result = self.fetch_page(endpoint, params, page=0, per_page=per_page)
+
             # Determine the response structure type
             if "prices" in result:
-                data_key = "prices"
-                # For the prices endpoint, we might not need pagination
-                if result.get(data_key):
-                    all_data.extend(result[data_key])
-                    
-                # If this endpoint doesn't support pagination, return immediately
+                # The prices endpoint is not paginated
+                all_data = result.get("prices") or []
                 self.logger.info(f"Found {len(all_data)} records from prices endpoint")
-                return pd.DataFrame(all_data) if all_data else pd.DataFrame()
-                
+
             elif "objects" in result:
-                data_key = "objects"
-                if result.get(data_key):
-                    all_data.extend(result[data_key].values())
-                    
-                # Continue with pagination for objects endpoints
-                page = 1  # Start with page 1 since we already processed page 0
-                
-                while True:
-                    # Update the page number
-                    request_params["pagination"]["page"] = page
-                    
-                    # Print to debug
-                    self.logger.info(f"Fetching page {page}...")
-                    
-                    # Make the request
-                    response = requests.post(url, headers=self.credentials, json=request_params)
-                    response.raise_for_status()
-                    result = response.json()
-                    
-                    # Check if we got any data
-                    if not result.get(data_key) or len(result[data_key]) == 0:
-                        self.logger.info(f"No more data found at page {page}")
-                        break
-                        
-                    # Add the data and increment the page
-                    all_data.extend(result[data_key].values())
-                    self.logger.info(f"Found {len(result[data_key])} records on page {page}")
-                    page += 1
-            
+                # Remaining pages are fetched concurrently by the client
+                all_data = self.fetch_records(
+                    endpoint, params, key="objects", per_page=per_page, first_page=result
+                )
+
             else:
                 # Unknown response structure
-                self.logger.warning(f"Unknown response structure: {list(result.keys())}")
-                return pd.DataFrame()  # Return empty DataFrame for unknown structure
-            
+                raise ValueError(f"Unknown response structure: {list(result.keys())}")
+
+        except (TransientAPIError, CacheMissError) as e:
+            # Retries exhausted or page missing from a replay: fail loudly
+            # instead of looking like "no data"
+            self.logger.error(f"Giving up on {endpoint}: {str(e)}")
+            raise
+
         except requests.exceptions.HTTPError as e:
             self.logger.error(f"HTTP error: {str(e)}")
             if e.response.status_code == 401:  # Unauthorized
                 self.logger.info("Token may have expired. Attempting to reauthenticate...")
                 try:
-                    self.authenticate()
+                    self.authenticate(force=True)
                     # Try again with fresh credentials
-                    return self.fetch_data(endpoint, params)
+                    return self.fetch_data(endpoint, params, schema)
                 except Exception as auth_error:
                     self.logger.error(f"Reauthentication failed: {str(auth_error)}")
-            return pd.DataFrame()  # Return empty DataFrame on error
-            
+                    raise
+            # Any other status is a failed fetch, not an empty day
+            raise
+
         except Exception as e:
             self.logger.error(f"Error fetching data from API: {str(e)}")
-            return pd.DataFrame()  # Return empty DataFrame on error
-        
-        # Return all collected data
-        return pd.DataFrame(all_data) if all_data else pd.DataFrame()
\ No newline at end of file
+            raise
+
+        # Return all collected data, typed and trimmed to the schema if given
+        return records_to_frame(all_data, schema)
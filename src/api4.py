@@ -1,155 +1,185 @@
+import json
+
+import numpy as np
 import pandas as pd
 import requests
-import logging
-import json
 
+from src.maravi import BaseMaraviAPI, run_sync
+from src.response_cache import CacheMissError
+from src.throttle import TransientAPIError
+
+
+# Columns taken from the portfolio rather than from each position
+PORTFOLIO_COLUMNS = ["portfolio_name", "portfolio_id", "date", "position_type"]
+
+# Column order of provision rows, matching the position rows they are stacked with
+PROVISION_COLUMNS = [
+    "portfolio_name",
+    "portfolio_id",
+    "date",
+    "instrument_name",
+    "quantity",
+    "price",
+    "asset_value",
+    "book_name",
+    "position_type",
+    "pct_net_asset_value",
+    "pct_asset_value",
+    "sector_name",
+]
+
+
+def _serialize_nested(values):
+    """JSON-encode dict/list values PostgreSQL can't store (empty ones become None)."""
+    if not any(isinstance(value, (dict, list)) for value in values):
+        return values
+    return [
+        (json.dumps(value) if value else None) if isinstance(value, (dict, list)) else value
+        for value in values
+    ]
+
+
+def flatten_portfolios(portfolios, columns=None):
+    """
+    Flatten the `objects` payload of portfolio_position/positions/get.
 
-class MaraviAPI:
-    def __init__(self, username, password, client_id, client_secret):
-        self.base_url = "https://tarpon.bluedeck.com.br/api"
-        self.username = username
-        self.password = password
-        self.client_id = client_id
-        self.client_secret = client_secret
-        self.credentials = None
-        self.logger = logging.getLogger("MaraviAPI")
-
-    def authenticate(self):
-        url = f"{self.base_url}/auth/token"
-        data = {
-            "username": self.username,
-            "password": self.password,
+    Walks the portfolios once, collecting references to their instrument
+    positions (rows of type POSITION) and financial transaction positions
+    (provisões, rows of type PROVISION). Portfolio-level fields are repeated
+    per row with np.repeat instead of being copied into every position dict.
+    With `columns`, only those columns are built, so nested fields are
+    JSON-encoded only when a caller keeps them.
+
+    Returns a (positions, provisions) tuple of DataFrames.
+    """
+    positions, provisions = [], []
+    position_counts, provision_counts = [], []
+    portfolio_ids, portfolio_names, portfolio_dates = [], [], []
+
+    for portfolio_id, portfolio_data in portfolios.items():
+        portfolio_ids.append(portfolio_id)
+        portfolio_names.append(portfolio_data.get("name"))
+        portfolio_dates.append(portfolio_data.get("date"))
+
+        instrument_positions = portfolio_data.get("instrument_positions") or []
+        positions.extend(instrument_positions)
+        position_counts.append(len(instrument_positions))
+
+        financial_transactions = portfolio_data.get("financial_transaction_positions") or []
+        provisions.extend(financial_transactions)
+        provision_counts.append(len(financial_transactions))
+
+    def portfolio_fields(counts, position_type):
+        total = sum(counts)
+        return {
+            "portfolio_name": np.repeat(np.array(portfolio_names, dtype=object), counts),
+            "portfolio_id": np.repeat(np.array(portfolio_ids, dtype=object), counts),
+            "date": np.repeat(np.array(portfolio_dates, dtype=object), counts),
+            "position_type": np.full(total, position_type, dtype=object),
         }
-        client_headers = {
-            "CF-Access-Client-Id": self.client_id,
-            "CF-Access-Client-Secret": self.client_secret,
+
+    # POSITION rows: every position field, portfolio fields taking precedence
+    position_columns = columns
+    if position_columns is None:
+        position_columns = list(dict.fromkeys(key for position in positions for key in position))
+        position_columns += [c for c in PORTFOLIO_COLUMNS if c not in position_columns]
+
+    position_data = {}
+    if positions:
+        shared = portfolio_fields(position_counts, "POSITION")
+        first = positions[0]
+        for column in position_columns:
+            if column in shared:
+                position_data[column] = shared[column]
+            elif column in first or any(column in position for position in positions):
+                values = [position.get(column) for position in positions]
+                position_data[column] = _serialize_nested(values)
+
+    # PROVISION rows: category_name becomes the instrument_name
+    provision_data = {}
+    if provisions:
+        shared = portfolio_fields(provision_counts, "PROVISION")
+        total = len(provisions)
+        provision_fields = {
+            "instrument_name": lambda: [t.get("category_name") for t in provisions],
+            "quantity": lambda: np.ones(total, dtype=np.int64),  # Quantidade conceitual
+            "price": lambda: [t.get("financial_value", 0) for t in provisions],
+            "asset_value": lambda: [t.get("financial_value", 0) for t in provisions],
+            "book_name": lambda: [t.get("book_name") for t in provisions],
+            # Provisões só têm pct_net_asset_value
+            "pct_net_asset_value": lambda: [t.get("pct_net_asset_value", 0) for t in provisions],
+            "pct_asset_value": lambda: np.full(total, np.nan),  # Provisões não têm esta coluna
+            "sector_name": lambda: np.full(total, "Não utilizar", dtype=object),  # Provisões não têm esta coluna
         }
-        
-        try:
-            response = requests.post(url, data=data, headers=client_headers)
-            response.raise_for_status()
-            token_json_response = response.json()
-            token_header = {
-                "Authorization": f"{token_json_response['token_type']} {token_json_response['access_token']}"
-            }
-            credentials = {**client_headers, **token_header}
-            self.credentials = credentials
-        except requests.exceptions.RequestException as e:
-            self.logger.error(f"Authentication failed: {str(e)}")
-            raise
+        for column in PROVISION_COLUMNS if columns is None else columns:
+            if column in shared:
+                provision_data[column] = shared[column]
+            elif column in provision_fields:
+                provision_data[column] = provision_fields[column]()
+
+    return pd.DataFrame(position_data), pd.DataFrame(provision_data)
 
-    def _clean_data_for_postgres(self, position):
-        """Remove or convert data types that PostgreSQL can't handle"""
-        cleaned_position = {}
-        
-        for key, value in position.items():
-            if isinstance(value, dict):
-                # Convert dict to JSON string
-                cleaned_position[key] = json.dumps(value) if value else None
-            elif isinstance(value, list):
-                # Convert list to JSON string
-                cleaned_position[key] = json.dumps(value) if value else None
-            else:
-                cleaned_position[key] = value
-                
-        return cleaned_position
 
-    def fetch_data(self, endpoint, params=None):
-        url = f"{self.base_url}/{endpoint}"
+class MaraviAPI(BaseMaraviAPI):
+    timeout = 30
 
+    def fetch_data(self, endpoint, params=None, columns=None, shard_size=None):
         if not self.credentials:
             self.logger.warning("No credentials available. Attempting to authenticate...")
             try:
                 self.authenticate()
             except Exception as e:
                 self.logger.error(f"Authentication failed: {str(e)}")
-                return pd.DataFrame()
-
-        all_positions = []
-        
-        if params is None:
-            params = {}
-            
-        request_params = params.copy()
-        request_params["pagination"] = {
-            "per_page": 10000,
-            "page": 0,
-        }
+                raise
 
         self.logger.info(f"Starting API requests to {endpoint}")
         
         try:
-            # Make request
-            response = requests.post(url, headers=self.credentials, json=request_params, timeout=30)
-            response.raise_for_status()
-            result = response.json()
-            
-            if "objects" in result:
-                portfolios = result.get("objects", {})
-                
-                for portfolio_id, portfolio_data in portfolios.items():
-                    # Extract portfolio info
-                    portfolio_name = portfolio_data.get("name")
-                    portfolio_date = portfolio_data.get("date")
-                    
-                    # Extract instrument positions
-                    instrument_positions = portfolio_data.get("instrument_positions", [])
-                    
-                    for position in instrument_positions:
-                        # Add portfolio info to each position
-                        position_with_portfolio = position.copy()
-                        position_with_portfolio["portfolio_name"] = portfolio_name
-                        position_with_portfolio["portfolio_id"] = portfolio_id
-                        position_with_portfolio["date"] = portfolio_date
-                        position_with_portfolio["position_type"] = "POSITION"
-                        
-                        # Clean data for PostgreSQL
-                        cleaned_position = self._clean_data_for_postgres(position_with_portfolio)
-                        all_positions.append(cleaned_position)
-                    
-                    # Extract financial transaction positions (provisões)
-                    financial_transactions = portfolio_data.get("financial_transaction_positions", [])
-                    
-                    for transaction in financial_transactions:
-                        # Convert provision to position format usando category_name como instrument_name
-                        provision_position = {
-                            "portfolio_name": portfolio_name,
-                            "portfolio_id": portfolio_id,
-                            "date": portfolio_date,
-                            "instrument_name": transaction.get("category_name"),
-                            "quantity": 1,  # Quantidade conceitual
-                            "price": transaction.get("financial_value", 0),
-                            "asset_value": transaction.get("financial_value", 0),
-                            "book_name": transaction.get("book_name"),
-                            "position_type": "PROVISION",
-                            # Provisões só têm pct_net_asset_value
-                            "pct_net_asset_value": transaction.get("pct_net_asset_value", 0),
-                            "pct_asset_value": None,  # Provisões não têm esta coluna,
-                            "sector_name": "Não utilizar" # Provisões não têm esta coluna
-                        }
-                        
-                        all_positions.append(provision_position)
-                
-                self.logger.info(f"Extracted {len([p for p in all_positions if p['position_type'] == 'POSITION'])} positions and {len([p for p in all_positions if p['position_type'] == 'PROVISION'])} provisions from {len(portfolios)} portfolios")
-                
+            shards = self.shards(params, "portfolio_ids", shard_size)
+            if shards:
+                # Portfolios are keyed by id, so merging shards de-duplicates them
+                portfolios = {}
+                for shard_portfolios in self.fetch_shards(
+                    lambda shard: self._fetch_portfolios(endpoint, shard), shards
+                ):
+                    portfolios.update(shard_portfolios or {})
             else:
-                self.logger.warning(f"Expected 'objects' key, but found: {list(result.keys())}")
-                return pd.DataFrame()
-            
+                portfolios = run_sync(self._fetch_portfolios(endpoint, params))
+
+            df_positions, df_provisions = flatten_portfolios(portfolios, columns)
+            self.logger.info(f"Extracted {len(df_positions)} positions and {len(df_provisions)} provisions from {len(portfolios)} portfolios")
+
+        except (TransientAPIError, CacheMissError) as e:
+            # Retries exhausted or page missing from a replay: fail loudly
+            # instead of looking like "no data"
+            self.logger.error(f"Giving up on {endpoint}: {str(e)}")
+            raise
+
         except requests.exceptions.HTTPError as e:
             self.logger.error(f"HTTP error: {str(e)}")
             if e.response.status_code == 401:
                 self.logger.info("Token may have expired. Attempting to reauthenticate...")
                 try:
-                    self.authenticate()
-                    return self.fetch_data(endpoint, params)
+                    self.authenticate(force=True)
+                    return self.fetch_data(endpoint, params, columns, shard_size)
                 except Exception as auth_error:
                     self.logger.error(f"Reauthentication failed: {str(auth_error)}")
-            return pd.DataFrame()
+                    raise
+            # Any other status is a failed fetch, not an empty day
+            raise
             
         except Exception as e:
             self.logger.error(f"Error fetching data from API: {str(e)}")
-            return pd.DataFrame()
+            raise
         
-        self.logger.info(f"Total records collected: {len(all_positions)}")
-        return pd.DataFrame(all_positions) if all_positions else pd.DataFrame()
\ No newline at end of file
+        frames = [df for df in (df_positions, df_provisions) if not df.empty]
+        self.logger.info(f"Total records collected: {len(df_positions) + len(df_provisions)}")
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    async def _fetch_portfolios(self, endpoint, params):
+        # Single request: this endpoint returns every portfolio on page 0
+        result = await self.client.fetch_page(endpoint, params, 0, self.per_page)
+
+        if "objects" not in result:
+            raise ValueError(f"Expected 'objects' key, but found: {list(result.keys())}")
+        return result.get("objects") or {}
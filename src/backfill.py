@@ -0,0 +1,67 @@
+import os
+import threading
+import time
+from typing import NamedTuple
+
+from src.logger import setup_logger
+
+logger = setup_logger(name="Backfill")
+
+DEFAULT_WORKERS = 4
+
+
+def backfill_workers(workers=None):
+    """Número de workers: o pedido, ou BACKFILL_WORKERS, ou DEFAULT_WORKERS."""
+    return max(1, workers or int(os.getenv("BACKFILL_WORKERS", DEFAULT_WORKERS)))
+
+
+class BackfillReport(NamedTuple):
+    label: str
+    total: int  # Itens (datas ou janelas) processados
+    failed: list  # (item, erro) dos que falharam
+    rows: int  # Linhas entregues para gravação
+    seconds: float
+
+    @property
+    def done(self):
+        return self.total - len(self.failed)
+
+    def summary(self):
+        seconds = max(self.seconds, 1e-9)
+        return (
+            f"{self.label}: {self.done}/{self.total} concluídos em {self.seconds:.1f}s "
+            f"({self.done / seconds:.2f}/s, {self.rows / seconds:.0f} linhas/s), "
+            f"{len(self.failed)} com erro"
+        )
+
+
+class Progress:
+    """Contadores de um backfill, atualizados pelos workers."""
+
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.rows = 0
+        self.failed = []
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_rows(self, rows):
+        with self._lock:
+            self.rows += rows or 0
+
+    def fail(self, item, error):
+        with self._lock:
+            self.failed.append((item, error))
+
+    def report(self, total=None):
+        report = BackfillReport(
+            self.label,
+            self.total if total is None else total,
+            list(self.failed),
+            self.rows,
+            time.perf_counter() - self.started,
+        )
+        logger.info(report.summary())
+        return report
+
@@ -1,8 +1,14 @@
 # based on: https://github.com/quantopian/trading_calendars/blob/master/trading_calendars/exchange_calendar_bvmf.py
 
+import functools
+import hashlib
+import json
+import os
+import types
+import zipfile
+import numpy as np
 import pandas as pd
 import datetime
-from dateutil.relativedelta import relativedelta
 
 from pandas.tseries.holiday import (
     AbstractHolidayCalendar,
@@ -18,6 +24,11 @@ from pandas.tseries.offsets import (
     CustomBusinessDay,
 )
 
+from src.logger import setup_logger
+from src.token_cache import default_cache_dir
+
+logger = setup_logger(name="Calendário")
+
 
 class HolidayCalendar(AbstractHolidayCalendar):
     def __init__(self, rules):
@@ -108,9 +119,96 @@ Natal = Holiday(
 CopaDoMundo2014 = Holiday("Copa Do Mundo 2014", month=6, day=12, year=2014)
 
 
-class TarponCalendar:
+# Horizonte padrão do calendário pré-calculado; consultas fora dele caem
+# nos offsets do pandas
+DEFAULT_START = datetime.date(2000, 1, 1)
+DEFAULT_END = datetime.date(2100, 12, 31)
+
+_ONE_DAY = np.timedelta64(1, "D")
+
+# Versão do formato do snapshot; mudar invalida os arquivos antigos
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ARRAYS = ("holidays", "business_days", "month_first_days", "month_last_days")
+
+
+def _is_array(date):
+    return isinstance(date, (list, tuple, np.ndarray, pd.Series, pd.Index))
+
+
+def _month_index(dates):
+    """Mês de cada data (datetime64[M]), na hora local se as datas têm fuso."""
+    index = pd.DatetimeIndex(dates)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    return index.values.astype("datetime64[M]")
+
+
+def _month_shift(date, months):
+    """
+    Primeiro dia do mês de `date` deslocado de `months` meses. Para um array
+    de datas, devolve um array datetime64[D].
+    """
+    if _is_array(date):
+        return (_month_index(date) + months).astype("datetime64[D]")
+    index = date.year * 12 + date.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
 
-    def __init__(self, include_new_years_eve_holiday=True) -> None:
+def _stable(value):
+    """Representação de um atributo de regra que não muda entre processos."""
+    if isinstance(value, types.FunctionType):
+        return f"{value.__module__}.{value.__qualname__}"
+    if isinstance(value, (list, tuple)):
+        return [_stable(item) for item in value]
+    if value is None or isinstance(value, (int, str)):
+        return value
+    return repr(value)
+
+
+def rules_fingerprint(rules, start, end):
+    """
+    Hash das regras de feriado e do horizonte: muda sempre que uma regra é
+    incluída, removida ou alterada, e com ela o snapshot usado.
+    """
+    spec = {
+        "version": SNAPSHOT_VERSION,
+        "start": str(start),
+        "end": str(end),
+        "rules": [
+            {name: _stable(value) for name, value in sorted(vars(rule).items())}
+            for rule in rules
+        ],
+    }
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def snapshot_dir():
+    return os.path.join(default_cache_dir(), "calendar")
+
+
+class TarponCalendar:
+    """
+    Calendário de dias úteis da B3.
+
+    Os métodos que recebem uma data também aceitam um array de datas (lista,
+    array do NumPy, Series ou DatetimeIndex) e então devolvem um
+    DatetimeIndex com uma resposta por data, calculado de uma vez.
+
+    Os dias úteis do horizonte [start, end] são pré-calculados num array
+    ordenado de datetime64[D], junto com o primeiro e o último dia útil de
+    cada mês; cada consulta é uma busca binária (searchsorted) nesses
+    arrays. Os resultados são os mesmos dos offsets CustomBusinessDay /
+    CustomBusinessMonthEnd / CustomBusinessMonthBegin do pandas, que ainda
+    respondem às consultas fora do horizonte ou com fuso horário.
+
+    Os arrays ficam num snapshot em .cache/calendar, identificado pelo hash
+    das regras e do horizonte; montar o calendário é então só ler o
+    arquivo. O snapshot é refeito quando as regras mudam.
+    """
+
+    def __init__(
+        self, include_new_years_eve_holiday=True, start=None, end=None, snapshot=True
+    ) -> None:
         _holiday_list = [
             ConfUniversal,
             CarnavalSegunda,
@@ -129,93 +227,241 @@ class TarponCalendar:
             Natal,
         ]
 
-        holiday_calendar = HolidayCalendar(_holiday_list)
-
-        self.custom_calendar_month_end = CustomBusinessMonthEnd(
-            calendar=holiday_calendar
-        )
-        self.custom_calendar_month_begin = CustomBusinessMonthBegin(
-            calendar=holiday_calendar
-        )
-        self.custom_calendar_day = CustomBusinessDay(calendar=holiday_calendar)
+        self.holiday_calendar = HolidayCalendar(_holiday_list)
+
+        # O horizonte cobre meses inteiros, para os arrays de início e fim de mês
+        start = start or DEFAULT_START
+        end = end or DEFAULT_END
+        self.start = np.datetime64(datetime.date(start.year, start.month, 1), "D")
+        self.end = np.datetime64(_month_shift(end, 1), "D") - _ONE_DAY
+
+        self.fingerprint = rules_fingerprint(_holiday_list, self.start, self.end)
+        arrays = self._load_snapshot() if snapshot else None
+        if arrays is None:
+            arrays = self._expand()
+            if snapshot:
+                self._save_snapshot(arrays)
+
+        self.holidays = arrays["holidays"]
+        self.business_days = arrays["business_days"]
+        self.month_first_days = arrays["month_first_days"]
+        self.month_last_days = arrays["month_last_days"]
+        self.busdaycal = np.busdaycalendar(holidays=self.holidays)
+
+    def _expand(self):
+        """Calcula feriados, dias úteis e primeiro/último dia útil de cada mês."""
+        holidays = self.holiday_calendar.holidays(
+            pd.Timestamp(self.start), pd.Timestamp(self.end)
+        ).values.astype("datetime64[D]")
+
+        days = np.arange(self.start, self.end + _ONE_DAY, dtype="datetime64[D]")
+        business_days = days[np.is_busday(days, holidays=holidays)]
+
+        months = business_days.astype("datetime64[M]")
+        new_month = np.flatnonzero(months[1:] != months[:-1]) + 1
+        return {
+            "holidays": holidays,
+            "business_days": business_days,
+            "month_first_days": business_days[np.r_[0, new_month]],
+            "month_last_days": business_days[np.r_[new_month - 1, len(months) - 1]],
+        }
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(snapshot_dir(), f"{self.fingerprint[:16]}.npz")
+
+    def _load_snapshot(self):
+        try:
+            with np.load(self.snapshot_path, allow_pickle=False) as data:
+                if str(data["fingerprint"]) != self.fingerprint:
+                    return None
+                return {name: data[name] for name in SNAPSHOT_ARRAYS}
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+
+    def _save_snapshot(self, arrays):
+        """Grava o snapshot e apaga os outros (de regras ou horizontes antigos)."""
+        path = self.snapshot_path
+        try:
+            os.makedirs(snapshot_dir(), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez_compressed(f, fingerprint=self.fingerprint, **arrays)
+            os.replace(tmp_path, path)
+            for name in os.listdir(snapshot_dir()):
+                if name.endswith(".npz") and name != os.path.basename(path):
+                    os.remove(os.path.join(snapshot_dir(), name))
+        except OSError as e:
+            logger.warning(f"Não foi possível gravar o snapshot do calendário: {e}")
+            return
+        logger.info(f"Snapshot do calendário gravado em {path}")
+
+    @functools.cached_property
+    def custom_calendar_day(self):
+        return CustomBusinessDay(calendar=self.holiday_calendar)
+
+    @functools.cached_property
+    def custom_calendar_month_end(self):
+        return CustomBusinessMonthEnd(calendar=self.holiday_calendar)
+
+    @functools.cached_property
+    def custom_calendar_month_begin(self):
+        return CustomBusinessMonthBegin(calendar=self.holiday_calendar)
+
+    def _day(self, date):
+        """
+        (dia em datetime64[D], hora do dia, unidade do Timestamp) de `date`,
+        ou None se `date` tem fuso.
+        """
+        if type(date) is datetime.date:
+            return np.datetime64(date, "D"), None, "s"
+        ts = pd.Timestamp(date)
+        if ts.tzinfo is not None:
+            return None
+        day = ts.normalize()
+        return np.datetime64(day.date(), "D"), ts - day, ts.unit
+
+    @staticmethod
+    def _timestamp(day, time, unit):
+        # Mesma unidade e hora do dia que o offset do pandas devolveria
+        ts = pd.Timestamp(day).as_unit(unit)
+        return ts + time if time else ts
+
+    def _lookup(self, date, table, side, shift, offset):
+        """
+        Busca `date` em `table` (dias úteis, inícios ou fins de mês) e anda
+        `shift` posições; `offset` responde quando a busca não vale.
+        """
+        if _is_array(date):
+            return self._lookup_many(date, table, side, shift, offset)
+
+        parsed = self._day(date)
+        if parsed is not None:
+            day, time, unit = parsed
+            index = table.searchsorted(day, side) + shift
+            if self.start <= day <= self.end and 0 <= index < len(table):
+                return self._timestamp(table[index], time, unit)
+        return offset(date)
+
+    def _lookup_many(self, dates, table, side, shift, offset):
+        dates = pd.DatetimeIndex(dates)
+        if dates.tz is not None:
+            return pd.DatetimeIndex([offset(date) for date in dates])
+
+        midnight = dates.normalize()
+        days = midnight.values.astype("datetime64[D]")
+        index = table.searchsorted(days, side) + shift
+        valid = (days >= self.start) & (days <= self.end) & (index >= 0) & (index < len(table))
+
+        values = np.full(len(days), np.datetime64("NaT"), "datetime64[ns]")
+        values[valid] = table[index[valid]]
+        values = values + (dates - midnight).values
+
+        # Datas fora do horizonte vão pelos offsets, uma a uma
+        outside = ~valid & ~dates.isna()
+        for position in np.flatnonzero(outside):
+            values[position] = offset(dates[position]).as_unit("ns").asm8
+        return pd.DatetimeIndex(values)
 
     def get_previous_trading_day(self, date: datetime.date):
-        return date - self.custom_calendar_day
+        return self._lookup(
+            date, self.business_days, "left", -1, lambda d: d - self.custom_calendar_day
+        )
 
     def get_last_trading_day_of_month(self, date: datetime.date):
         """Function that return the last day of trading given a date"""
-        return date + self.custom_calendar_month_end
+        return self._lookup(
+            date, self.month_last_days, "right", 0, lambda d: d + self.custom_calendar_month_end
+        )
 
     def get_first_trading_day_of_month(self, date: datetime.date):
         """Function that return the first day of trading given a date"""
-        return date - self.custom_calendar_month_begin
+        return self._lookup(
+            date, self.month_first_days, "left", -1, lambda d: d - self.custom_calendar_month_begin
+        )
 
     def get_last_trading_day_of_previous_month(self, date: datetime.date):
-        date = datetime.date(date.year, date.month, 1) - relativedelta(months=1)
-
-        return self.get_last_trading_day_of_month(date)
+        return self.get_last_trading_day_of_month(_month_shift(date, -1))
 
     def get_last_trading_day_of_previous_year(self, date: datetime.date):
         """
         Função que retorna o último dia útil do ano anterior à data fornecida.
         """
-        date = datetime.date(date.year - 1, 12, 1)
+        if _is_array(date):
+            date = (_month_index(date).astype("datetime64[Y]") - 1).astype("datetime64[M]") + 11
+            date = date.astype("datetime64[D]")
+        else:
+            date = datetime.date(date.year - 1, 12, 1)
 
         # Usa a função get_last_trading_day_of_month para garantir que é um dia útil
         return self.get_last_trading_day_of_month(date)
 
     def get_last_trading_day_of_ltm(self, date: datetime.date):
-        date = datetime.date(date.year, date.month, 1) - relativedelta(months=12)
-
-        return self.get_last_trading_day_of_month(date)
+        return self.get_last_trading_day_of_month(_month_shift(date, -12))
 
     def get_last_trading_day_of_last_six_month(self, date: datetime.date):
-        date = datetime.date(date.year, date.month, 1) - relativedelta(months=6)
-
-        return self.get_last_trading_day_of_month(date)
+        return self.get_last_trading_day_of_month(_month_shift(date, -6))
 
     def get_last_trading_day_of_24m(self, date: datetime.date):
-        date = datetime.date(date.year, date.month, 1) - relativedelta(months=24)
-
-        return self.get_last_trading_day_of_month(date)
+        return self.get_last_trading_day_of_month(_month_shift(date, -24))
 
     def get_last_trading_day_of_36m(self, date: datetime.date):
-        date = datetime.date(date.year, date.month, 1) - relativedelta(months=36)
-
-        return self.get_last_trading_day_of_month(date)
+        return self.get_last_trading_day_of_month(_month_shift(date, -36))
 
     def get_last_trading_day_of_48m(self, date: datetime.date):
-        date = datetime.date(date.year, date.month, 1) - relativedelta(months=48)
-
-        return self.get_last_trading_day_of_month(date)
+        return self.get_last_trading_day_of_month(_month_shift(date, -48))
 
     def get_last_trading_day_of_60m(self, date: datetime.date):
-        date = datetime.date(date.year, date.month, 1) - relativedelta(months=60)
-
-        return self.get_last_trading_day_of_month(date)
+        return self.get_last_trading_day_of_month(_month_shift(date, -60))
 
     def get_business_days_in_month(self, year, month):
         date_start = datetime.date(year, month, 1)
-        date_end = date_start + relativedelta(months=1) - datetime.timedelta(days=1)
+        date_end = _month_shift(date_start, 1) - datetime.timedelta(days=1)
         return self.get_business_days_in_range(date_start, date_end)
 
     def get_business_days_in_range(
         self, start_date: datetime.date, end_date: datetime.date
     ):
         """
-        Calcula a quantidade de dias úteis em um intervalo de datas usando pandas.
+        Dias úteis entre start_date e end_date, inclusive.
 
         Parameters:
         start_date (datetime.date): Data inicial
         end_date (datetime.date): Data final
 
         Returns:
-        int: Número de dias úteis no intervalo
+        pd.DatetimeIndex: Dias úteis no intervalo
         """
+        first = self._day(start_date)
+        last = self._day(end_date)
+        if (
+            first is not None
+            and last is not None
+            and not first[1]
+            and not last[1]
+            and self.start <= first[0]
+            and last[0] <= self.end
+        ):
+            lo = self.business_days.searchsorted(first[0], "left")
+            hi = self.business_days.searchsorted(last[0], "right")
+            return pd.DatetimeIndex(self.business_days[lo:hi].astype("datetime64[ns]"))
 
         # Criar um range de datas de negociação usando o calendário personalizado
-        business_days = pd.date_range(
-            start=start_date, end=end_date, freq=self.custom_calendar_day
+        return pd.date_range(start=start_date, end=end_date, freq=self.custom_calendar_day)
+
+    def month_ends(self, start, end):
+        """
+        Gera o último dia útil de cada mês, do mês de `start` ao mês de
+        `end` (inclusive), em ordem.
+        """
+        months = np.arange(
+            _month_index([start])[0], _month_index([end])[0] + 1, dtype="datetime64[M]"
         )
+        # O último dia do mês anterior leva ao fim de mês útil seguinte
+        yield from self.get_last_trading_day_of_month(months.astype("datetime64[D]") - _ONE_DAY)
+
 
-        return business_days
+@functools.lru_cache(maxsize=None)
+def get_calendar():
+    """Calendário compartilhado pelo processo, montado no primeiro uso."""
+    return TarponCalendar()
@@ -1,9 +1,16 @@
+import datetime
+import io
+import json
 import os
+import threading
 from sqlalchemy import create_engine
 import pandas as pd
 
+# Linhas por comando COPY ao gravar com append_to_db e upsert_to_db
+COPY_CHUNK_SIZE = 50_000
 
-def get_engine():
+
+def create_db_engine():
     DB_HOST = os.getenv("DB_HOST")
     DB_USER = os.getenv("DB_USER")
     DB_PASS = os.getenv("DB_PASS")
@@ -18,14 +25,32 @@ def get_engine():
     return engine
 
 
-engine = get_engine()
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Engine do processo, criado no primeiro uso (importar o módulo não conecta)."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_db_engine()
+        return _engine
+
+
+def __getattr__(name):
+    # Mantém `from src.db import engine` / `db.engine` funcionando sem criar
+    # o engine na importação
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def table_exists(table_name, schema):
     """Verifica se uma tabela existe no banco de dados."""
     from sqlalchemy import inspect
 
-    inspector = inspect(engine)
+    inspector = inspect(get_engine())
     return table_name in inspector.get_table_names(schema=schema)
 
 
@@ -41,20 +66,104 @@ def get_data_from_db(table_name, schema="movimentacoes"):
         pd.DataFrame: DataFrame com os dados da tabela.
     """
     query = f"SELECT * FROM {schema}.{table_name}"
-    df = pd.read_sql(query, engine)
+    df = pd.read_sql(query, get_engine())
     return df
 
 
-def append_to_db(df, table_name, schema="movimentacoes", if_exists="append"):
+def _copy_value(value):
+    """
+    Formata um valor para COPY ... WITH (FORMAT csv).
+
+    NULL vai sem aspas e vazio, e textos vão sempre entre aspas, para que
+    '' continue diferente de NULL. dict/list são gravados como JSON.
+    """
+    if value is None or value is pd.NaT:
+        return ""
+    if isinstance(value, float) and value != value:  # NaN
+        return ""
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value, ensure_ascii=False, default=str)
+    elif isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    elif isinstance(value, (bool, int, float)):
+        return str(value)
+    else:
+        value = str(value)
+    return '"' + value.replace('"', '""') + '"'
+
+
+def _copy_rows(dbapi_conn, table_name, keys, rows):
+    """Grava as tuplas de `rows` em `table_name` com um único COPY FROM STDIN."""
+    buffer = io.StringIO()
+    count = 0
+    for row in rows:
+        buffer.write(",".join(_copy_value(value) for value in row))
+        buffer.write("\n")
+        count += 1
+    buffer.seek(0)
+
+    columns = ", ".join(f'"{key}"' for key in keys)
+    sql = f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv)"
+
+    with dbapi_conn.cursor() as cursor:
+        if hasattr(cursor, "copy_expert"):  # psycopg2
+            cursor.copy_expert(sql, buffer)
+        else:  # psycopg 3
+            with cursor.copy(sql) as copy:
+                copy.write(buffer.getvalue())
+    return count
+
+
+def copy_insert(table, conn, keys, data_iter):
+    """
+    Método para `DataFrame.to_sql` que grava cada bloco com COPY FROM STDIN.
+
+    O pandas já converte NaN, NaT e Int64 NA em None antes de chamar o
+    método, então cada bloco vira um CSV em memória e um único COPY.
+    """
+    table_name = f'"{table.schema}"."{table.name}"' if table.schema else f'"{table.name}"'
+    return _copy_rows(conn.connection, table_name, keys, data_iter)
+
+
+def _frame_rows(df):
+    """Tuplas de `df` com NaN/NaT/NA trocados por None, como o to_sql entrega."""
+    values = df.astype(object).where(df.notna(), None)
+    return values.itertuples(index=False, name=None)
+
+
+def append_to_db(df, table_name, schema="movimentacoes", if_exists="append", copy=True):
+    """
+    Grava `df` na tabela, criando-a se preciso.
+
+    Por padrão os dados vão em blocos de COPY_CHUNK_SIZE linhas via COPY,
+    bem mais rápido que os INSERTs do to_sql; `copy=False` volta ao to_sql
+    padrão. Tabelas conhecidas (src.schema.TABLES) são criadas já com chave
+    primária e índices, e as particionadas ganham as partições que faltam.
+    """
+    from src import schema as table_schema
+
+    if if_exists == "append":
+        table_schema.prepare_table(df, table_name, schema)
 
-    df.to_sql(table_name, engine, schema=schema, if_exists=if_exists, index=False)
+    if copy:
+        df.to_sql(
+            table_name,
+            get_engine(),
+            schema=schema,
+            if_exists=if_exists,
+            index=False,
+            method=copy_insert,
+            chunksize=COPY_CHUNK_SIZE,
+        )
+    else:
+        df.to_sql(table_name, get_engine(), schema=schema, if_exists=if_exists, index=False)
     print("New data appended to PostgreSQL table successfully!")
 
 
 def append_to_db2(df, table_name, schema="movimentacoes", if_exists="append"):
     try:
         # Tenta inserção normal
-        df.to_sql(table_name, engine, schema=schema, if_exists=if_exists, index=False)
+        df.to_sql(table_name, get_engine(), schema=schema, if_exists=if_exists, index=False)
     except Exception as e:
         if "duplicate key" in str(e).lower():
             # Usa SQL nativo com ON CONFLICT
@@ -70,8 +179,134 @@ def append_to_db2(df, table_name, schema="movimentacoes", if_exists="append"):
                 ON CONFLICT (id) DO NOTHING
             """
             
-            with engine.connect() as conn:
+            with get_engine().connect() as conn:
                 conn.execute(text(sql), df.to_dict('records'))
                 conn.commit()
         else:
-            raise e
\ No newline at end of file
+            raise e
+
+_unique_keys = {}  # (schema, tabela, chaves) -> se há índice único nas chaves
+
+
+def unique_index_name(table_name, key_columns):
+    """Nome do índice único das chaves, comum a upsert_to_db e src.schema."""
+    return f"{table_name}_{'_'.join(key_columns)}_key"[:63]
+
+
+def _ensure_unique_index(schema, table_name, key_columns):
+    """
+    Cria, se preciso, um índice único nas colunas-chave. Retorna False
+    quando a tabela já tem chaves duplicadas e o índice não pode existir.
+    """
+    from psycopg2.errors import UniqueViolation
+    from sqlalchemy import text
+    from sqlalchemy.exc import IntegrityError
+
+    cache_key = (schema, table_name, tuple(key_columns))
+    if cache_key not in _unique_keys:
+        index_name = unique_index_name(table_name, key_columns)
+        columns = ", ".join(f'"{col}"' for col in key_columns)
+        try:
+            with get_engine().begin() as conn:
+                # Chave primária ou índice único já existente nas mesmas colunas, com qualquer nome
+                existing = conn.execute(
+                    text(
+                        "SELECT 1 FROM pg_index i "
+                        "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+                        "WHERE i.indrelid = CAST(:table AS regclass) AND i.indisunique "
+                        "AND i.indpred IS NULL AND i.indexprs IS NULL "
+                        "GROUP BY i.indexrelid, i.indnatts "
+                        "HAVING count(*) = i.indnatts "
+                        "AND array_agg(a.attname::text ORDER BY a.attname::text) = CAST(:columns AS text[])"
+                    ),
+                    {"table": f'"{schema}"."{table_name}"', "columns": sorted(key_columns)},
+                ).first()
+                if existing is None:
+                    conn.execute(text(
+                        f'CREATE UNIQUE INDEX IF NOT EXISTS "{index_name}" '
+                        f'ON "{schema}"."{table_name}" ({columns})'
+                    ))
+            _unique_keys[cache_key] = True
+        except IntegrityError as e:
+            # Só chaves duplicadas impedem o índice de vez; outros erros sobem
+            # e a próxima chamada tenta de novo
+            if not isinstance(e.orig, UniqueViolation):
+                raise
+            print(f"Sem índice único em {schema}.{table_name} ({columns}): {e}")
+            _unique_keys[cache_key] = False
+    return _unique_keys[cache_key]
+
+
+def upsert_to_db(df, table_name, key_columns, schema="movimentacoes", on_conflict="nothing"):
+    """
+    Grava em `table_name` apenas as linhas de `df` cujas chaves ainda não
+    existem, sem ler a tabela para o pandas.
+
+    O lote vai via COPY para uma tabela temporária e é mesclado no servidor
+    com INSERT ... ON CONFLICT, de modo que o custo depende do tamanho do
+    lote e não do histórico. Com on_conflict="update" as linhas existentes
+    são atualizadas com os valores do lote. Se a tabela tem chaves
+    duplicadas (e portanto não aceita índice único), a mescla usa NOT EXISTS.
+
+    Retorna o número de linhas inseridas (ou atualizadas).
+    """
+    from sqlalchemy import text
+
+    if on_conflict not in ("nothing", "update"):
+        raise ValueError(f"on_conflict deve ser 'nothing' ou 'update', não {on_conflict!r}")
+
+    if df.empty:
+        return 0
+
+    if not table_exists(table_name, schema):
+        append_to_db(df, table_name=table_name, schema=schema)
+        _ensure_unique_index(schema, table_name, key_columns)
+        return len(df)
+
+    unique = _ensure_unique_index(schema, table_name, key_columns)
+
+    target = f'"{schema}"."{table_name}"'
+    stage = f'"stage_{table_name}"'
+    columns = list(df.columns)
+    column_list = ", ".join(f'"{col}"' for col in columns)
+    key_list = ", ".join(f'"{col}"' for col in key_columns)
+    not_null = " AND ".join(f'"{col}" IS NOT NULL' for col in key_columns)
+    updates = [col for col in columns if col not in key_columns]
+
+    select = (
+        f"SELECT DISTINCT ON ({key_list}) {column_list} FROM {stage} "
+        f"WHERE {not_null} ORDER BY {key_list}"
+    )
+
+    with get_engine().begin() as conn:
+        conn.execute(text(
+            f"CREATE TEMP TABLE {stage} (LIKE {target} INCLUDING DEFAULTS) ON COMMIT DROP"
+        ))
+        for start in range(0, len(df), COPY_CHUNK_SIZE):
+            _copy_rows(conn.connection, stage, columns, _frame_rows(df.iloc[start:start + COPY_CHUNK_SIZE]))
+
+        if unique:
+            if on_conflict == "update" and updates:
+                set_list = ", ".join(f'"{col}" = EXCLUDED."{col}"' for col in updates)
+                action = f"DO UPDATE SET {set_list}"
+            else:
+                action = "DO NOTHING"
+            result = conn.execute(text(
+                f"INSERT INTO {target} ({column_list}) {select} "
+                f"ON CONFLICT ({key_list}) {action}"
+            ))
+            return result.rowcount
+
+        match = " AND ".join(f't."{col}" = s."{col}"' for col in key_columns)
+        updated = 0
+        if on_conflict == "update" and updates:
+            set_list = ", ".join(f'"{col}" = s."{col}"' for col in updates)
+            updated = conn.execute(text(
+                f"UPDATE {target} t SET {set_list} FROM ({select}) s WHERE {match}"
+            )).rowcount
+        inserted = conn.execute(text(
+            f"INSERT INTO {target} ({column_list}) "
+            f"SELECT {column_list} FROM ({select}) s "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {target} t WHERE {match})"
+        )).rowcount
+        return inserted + updated
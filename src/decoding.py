@@ -0,0 +1,54 @@
+import json
+
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speed-up
+    orjson = None
+
+# Column kinds understood by records_to_frame
+NUMERIC = "numeric"  # pd.to_numeric(errors="coerce")
+DATETIME = "datetime"  # pd.to_datetime(errors="coerce")
+INT64 = "Int64"  # nullable integer
+OBJECT = None  # kept as returned by the API
+
+
+def loads(body):
+    """Parse a JSON response body (bytes or str), using orjson when installed."""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def _typed_column(values, kind):
+    if kind == NUMERIC:
+        return pd.to_numeric(values, errors="coerce")
+    if kind == DATETIME:
+        return pd.to_datetime(values, errors="coerce")
+    if kind is None:
+        return values
+    return pd.array(values, dtype=kind)
+
+
+def records_to_frame(records, schema=None):
+    """
+    Build a typed DataFrame from a page of API records.
+
+    With a schema, each listed column is gathered and typed on its own and
+    every other field is dropped, so no frame of all the API fields is ever
+    built. Columns no record carries are left out, as pd.DataFrame would.
+    """
+    if not records:
+        return pd.DataFrame()
+    if schema is None:
+        return pd.DataFrame(records)
+
+    first = records[0]
+    columns = {}
+    for column, kind in schema.items():
+        if column not in first and not any(column in record for record in records):
+            continue
+        values = [record.get(column) for record in records]
+        columns[column] = _typed_column(values, kind)
+    return pd.DataFrame(columns)
@@ -0,0 +1,125 @@
+import datetime
+
+import pandas as pd
+from sqlalchemy import text
+
+from src import db, ledger
+from src.calendar import get_calendar
+from src.logger import setup_logger
+from src.schema import DEFAULT_SCHEMA
+
+logger = setup_logger(name="Lacunas")
+
+# Uma data com menos que esta fração das linhas típicas da vizinhança é
+# considerada incompleta (só em tabelas de snapshot, ver plan_gaps)
+INCOMPLETE_FRACTION = 0.5
+NEIGHBOURHOOD = 21  # Datas usadas para calcular as linhas típicas de cada data
+
+
+def date_counts(table_name, column, start, end, schema=DEFAULT_SCHEMA):
+    """Linhas por dia de `column` entre `start` e `end`, numa única consulta agrupada."""
+    query = text(
+        f'SELECT "{column}"::date AS day, count(*) AS n FROM "{schema}"."{table_name}" '
+        f'WHERE "{column}" >= :start AND "{column}" < :end GROUP BY 1'
+    )
+    params = {
+        "start": pd.Timestamp(start).date(),
+        "end": pd.Timestamp(end).date() + datetime.timedelta(days=1),
+    }
+    with db.get_engine().connect() as conn:
+        rows = conn.execute(query, params).all()
+    return pd.Series(
+        [n for _, n in rows],
+        index=pd.DatetimeIndex([pd.Timestamp(day) for day, _ in rows]),
+        dtype="int64",
+    ).sort_index()
+
+
+def first_date(table_name, column, schema=DEFAULT_SCHEMA):
+    """Primeira data gravada na tabela, ou None se ela não existe ou está vazia."""
+    if not db.table_exists(table_name, schema):
+        return None
+    with db.get_engine().connect() as conn:
+        value = conn.execute(
+            text(f'SELECT min("{column}") FROM "{schema}"."{table_name}"')
+        ).scalar()
+    return None if value is None else pd.Timestamp(value).normalize()
+
+
+def expected_dates(table_name, column, start=None, end=None, monthly=False, schema=DEFAULT_SCHEMA):
+    """
+    Datas que a tabela deveria ter entre `start` e `end`: os dias úteis ou,
+    com `monthly`, o último dia útil de cada mês. Sem `start`, começa na
+    primeira data já gravada; sem `end`, vai até o último dia útil.
+    """
+    calendar = get_calendar()
+    if end is None:
+        end = calendar.get_previous_trading_day(datetime.date.today())
+    if start is None:
+        start = first_date(table_name, column, schema)
+        if start is None:
+            raise ValueError(f"{schema}.{table_name} está vazia; informe a data inicial")
+
+    if monthly:
+        # month_ends inclui o fim do mês de `end`, mesmo depois de `end`
+        month_ends = pd.DatetimeIndex(list(calendar.month_ends(start, end)))
+        return month_ends[month_ends <= pd.Timestamp(end)]
+    return calendar.get_business_days_in_range(start, end)
+
+
+def find_gaps(expected, counts, min_fraction=None):
+    """
+    (datas sem nenhuma linha, datas incompletas) de `expected`, dadas as
+    linhas por dia `counts`. Uma data é incompleta quando tem menos que
+    `min_fraction` da mediana das datas vizinhas; sem `min_fraction`, só
+    as datas vazias contam.
+    """
+    expected = pd.DatetimeIndex(expected)
+    counts = counts.reindex(expected, fill_value=0)
+    missing = expected[counts.values == 0]
+
+    present = counts[counts > 0]
+    if min_fraction is None or present.empty:
+        return missing, expected[:0]
+
+    typical = present.rolling(NEIGHBOURHOOD, center=True, min_periods=1).median()
+    incomplete = present.index[present < typical * min_fraction]
+    return missing, incomplete
+
+
+def plan_gaps(
+    job,
+    table_name,
+    column,
+    expected,
+    payload,
+    min_fraction=None,
+    force=False,
+    schema=DEFAULT_SCHEMA,
+):
+    """
+    Datas de `expected` que o backfill de `job` precisa buscar.
+
+    Datas sem nenhuma linha ou incompletas entram se o run_ledger não as dá
+    como concluídas com o mesmo payload (uma data vazia fica registrada lá
+    depois de fechada, ver ledger.record).
+    `min_fraction` só faz sentido em tabelas de snapshot (preços, PLs,
+    posições), em que todo dia tem mais ou menos as mesmas linhas; em
+    tabelas de eventos (operações, movimentações) fica None. Com `force`,
+    todas as datas são buscadas de novo.
+    """
+    expected = pd.DatetimeIndex(expected)
+    if force or expected.empty or not db.table_exists(table_name, schema):
+        return list(expected)
+
+    counts = date_counts(table_name, column, expected[0], expected[-1], schema)
+    missing, incomplete = find_gaps(expected, counts, min_fraction)
+    missing = ledger.pending(job, missing, payload)
+    incomplete = ledger.pending(job, incomplete, payload)
+
+    dates = sorted(set(missing) | set(incomplete))
+    logger.info(
+        f"{job}: {len(missing)} datas sem dados e {len(incomplete)} incompletas "
+        f"de {len(expected)} entre {expected[0]:%Y-%m-%d} e {expected[-1]:%Y-%m-%d}"
+    )
+    return dates
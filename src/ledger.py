@@ -0,0 +1,127 @@
+import datetime
+import hashlib
+import threading
+
+import pandas as pd
+from sqlalchemy import text
+
+from src import db
+from src.calendar import get_calendar
+from src.logger import setup_logger
+from src.response_cache import canonical_payload
+
+logger = setup_logger(name="Ledger")
+
+LEDGER_SCHEMA = "tarpon_base"
+LEDGER_TABLE = "run_ledger"
+
+_ready = set()  # Schemas em que a tabela já foi garantida neste processo
+_ready_lock = threading.Lock()
+
+
+def payload_hash(payload):
+    """sha256 do payload canônico da requisição de uma unidade."""
+    return hashlib.sha256(canonical_payload(payload).encode("utf-8")).hexdigest()
+
+
+def _day(date):
+    return pd.Timestamp(date).date()
+
+
+def is_closed(date):
+    """
+    Se o dia já está fechado na API: anterior ao último dia útil, que pode
+    ainda não ter sido publicado por inteiro.
+    """
+    return _day(date) < _day(get_calendar().get_previous_trading_day(datetime.date.today()))
+
+
+def _ensure_table(schema):
+    with _ready_lock:
+        if schema in _ready:
+            return
+        with db.get_engine().begin() as conn:
+            conn.execute(text(
+                f'CREATE TABLE IF NOT EXISTS "{schema}".{LEDGER_TABLE} ('
+                "job TEXT NOT NULL, "
+                "date DATE NOT NULL, "
+                "rows BIGINT NOT NULL, "
+                "payload_hash TEXT NOT NULL, "
+                "seconds DOUBLE PRECISION NOT NULL, "
+                "completed_at TIMESTAMP NOT NULL DEFAULT now(), "
+                "PRIMARY KEY (job, date))"
+            ))
+        _ready.add(schema)
+
+
+def completed(job, dates, payload, schema=LEDGER_SCHEMA):
+    """
+    Datas de `dates` já concluídas por `job` com o mesmo payload. `payload`
+    é uma função data -> payload da requisição; se o payload de uma data
+    mudou (outros filtros, outras colunas), ela não conta como concluída.
+    """
+    days = sorted({_day(d) for d in dates})
+    if not days:
+        return set()
+
+    _ensure_table(schema)
+    with db.get_engine().connect() as conn:
+        rows = conn.execute(
+            text(
+                f'SELECT date, payload_hash FROM "{schema}".{LEDGER_TABLE} '
+                "WHERE job = :job AND date >= :start AND date <= :end"
+            ),
+            {"job": job, "start": days[0], "end": days[-1]},
+        ).all()
+
+    recorded = {_day(date): digest for date, digest in rows}
+    return {
+        day for day in days
+        if day in recorded and recorded[day] == payload_hash(payload(pd.Timestamp(day)))
+    }
+
+
+def pending(job, dates, payload, force=False, schema=LEDGER_SCHEMA):
+    """As datas de `dates` que ainda precisam rodar (todas, com `force`)."""
+    dates = list(dates)
+    if force:
+        return dates
+    done = completed(job, dates, payload, schema)
+    if done:
+        logger.info(f"{job}: {len(done)} de {len(dates)} datas já concluídas no {LEDGER_TABLE}, pulando")
+    return [d for d in dates if _day(d) not in done]
+
+
+def is_done(job, date, payload, force=False, schema=LEDGER_SCHEMA):
+    return not pending(job, [date], payload, force, schema)
+
+
+def record(job, date, rows, payload, seconds, schema=LEDGER_SCHEMA):
+    """
+    Registra a data como concluída por `job`. Uma data sem nenhuma linha
+    só é registrada se já está fechada (is_closed): antes disso a API pode
+    ainda não ter publicado o dia, e ele deve ser buscado de novo. Fechada,
+    fica registrada como vazia, para as tabelas de eventos (dias sem
+    operações ou movimentações) não a buscarem de novo a cada backfill.
+    """
+    if not rows and not is_closed(date):
+        return
+
+    _ensure_table(schema)
+    with db.get_engine().begin() as conn:
+        conn.execute(
+            text(
+                f'INSERT INTO "{schema}".{LEDGER_TABLE} (job, date, rows, payload_hash, seconds) '
+                "VALUES (:job, :date, :rows, :payload_hash, :seconds) "
+                "ON CONFLICT (job, date) DO UPDATE SET "
+                "rows = EXCLUDED.rows, payload_hash = EXCLUDED.payload_hash, "
+                "seconds = EXCLUDED.seconds, completed_at = now()"
+            ),
+            {
+                "job": job,
+                "date": _day(date),
+                "rows": int(rows),
+                "payload_hash": payload_hash(payload(pd.Timestamp(date))),
+                "seconds": float(seconds),
+            },
+        )
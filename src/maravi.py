@@ -0,0 +1,596 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.decoding import loads, records_to_frame
+from src.logger import setup_logger
+from src.page_size import get_page_sizer
+from src.response_cache import REPLAY, USE, get_response_cache
+from src.throttle import (
+    DEFAULT_MAX_RETRIES,
+    RETRY_EXCEPTIONS,
+    RETRY_STATUSES,
+    TransientAPIError,
+    backoff_delay,
+    get_circuit_breaker,
+    get_rate_limiter,
+    retry_after_seconds,
+)
+from src.token_cache import get_token_cache
+
+BASE_URL = "https://tarpon.bluedeck.com.br/api"
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_SHARD_SIZE = 10
+DEFAULT_MAX_ROWS = 5_000_000  # Per fetch; replaces the old fixed page caps
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+logger = setup_logger(name="MaraviAPI")
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_clients = {}  # Authenticated clients by class
+_clients_lock = threading.Lock()
+
+
+def run_sync(coro):
+    """
+    Run a coroutine to completion from synchronous code.
+
+    Uses asyncio.run when no event loop is running in this thread; otherwise
+    (e.g. inside a notebook) runs it on a fresh loop in a helper thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+def get_session(pool_size=None):
+    """
+    Return the process-wide keep-alive session for the given pool size.
+
+    Sessions are shared between client instances so that consecutive run()
+    calls in a backfill reuse the same TCP/TLS connections.
+    """
+    pool_size = pool_size or int(os.getenv("MARAVI_POOL_SIZE", DEFAULT_POOL_SIZE))
+
+    with _sessions_lock:
+        session = _sessions.get(pool_size)
+        if session is None:
+            session = requests.Session()
+            # pool_block keeps us at pool_size sockets instead of opening
+            # throwaway connections when every pooled one is busy.
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=pool_size, pool_block=True
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({"Accept-Encoding": "gzip, deflate"})
+            _sessions[pool_size] = session
+        return session
+
+
+def get_client(api_class):
+    """
+    Return the process-wide authenticated client of `api_class`.
+
+    Credentials come from MARAVI_USER, MARAVI_PASS, MARAVI_CLIENT_ID and
+    MARAVI_CLIENT_SECRET. The client is built and authenticated on first
+    use, so importing a job module never touches the network.
+    """
+    with _clients_lock:
+        client = _clients.get(api_class)
+        if client is None:
+            client = api_class(
+                os.getenv("MARAVI_USER"),
+                os.getenv("MARAVI_PASS"),
+                os.getenv("MARAVI_CLIENT_ID"),
+                os.getenv("MARAVI_CLIENT_SECRET"),
+            )
+            client.authenticate()
+            _clients[api_class] = client
+        return client
+
+
+def _env_timeout(name, default):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return float(value)
+
+
+def shard_params(params, shard_key, shard_size):
+    """Split the list in params[shard_key] into requests of at most shard_size values."""
+    values = list(params[shard_key])
+    return [
+        {**params, shard_key: values[i : i + shard_size]}
+        for i in range(0, len(values), shard_size)
+    ]
+
+
+def extract_items(result, key):
+    """Return the records stored under `key` as a list (dict values or list items)."""
+    data = result.get(key)
+    if not data:
+        return []
+    if isinstance(data, dict):
+        return list(data.values())
+    return list(data)
+
+
+class AsyncMaraviAPI:
+    """
+    Asynchronous Maravi client.
+
+    Blocking HTTP calls run in worker threads so that up to `max_concurrency`
+    page requests can be in flight at once, all over one pooled keep-alive
+    session. Requests are paced per endpoint by an adaptive token bucket and
+    retried on transient errors (see src.throttle). `read_timeout` is the
+    default for endpoints that need one and can be overridden with
+    MARAVI_READ_TIMEOUT.
+    """
+
+    def __init__(
+        self,
+        username,
+        password,
+        client_id,
+        client_secret,
+        max_concurrency=None,
+        read_timeout=None,
+        connect_timeout=None,
+        pool_size=None,
+        session=None,
+        token_cache=None,
+        max_retries=None,
+        page_sizer=None,
+        response_cache=None,
+    ):
+        self.base_url = BASE_URL
+        self.username = username
+        self.password = password
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.credentials = None
+        self.max_concurrency = max_concurrency or int(
+            os.getenv("MARAVI_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)
+        )
+        self.timeout = (
+            connect_timeout
+            or _env_timeout("MARAVI_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT),
+            _env_timeout("MARAVI_READ_TIMEOUT", read_timeout),
+        )
+        pool_size = pool_size or int(os.getenv("MARAVI_POOL_SIZE", DEFAULT_POOL_SIZE))
+        self.session = session or get_session(max(pool_size, self.max_concurrency))
+        self.token_cache = token_cache or get_token_cache()
+        self.page_sizer = page_sizer or get_page_sizer()
+        self.response_cache = response_cache or get_response_cache()
+        self.max_retries = (
+            max_retries
+            if max_retries is not None
+            else int(os.getenv("MARAVI_MAX_RETRIES", DEFAULT_MAX_RETRIES))
+        )
+        self.logger = logger
+        # Bounds requests in flight across every thread and event loop using
+        # this client (get_client shares one between backfill workers)
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+
+    def _send(self, url, **kwargs):
+        # Runs in a worker thread: waiting for a slot blocks that thread,
+        # never an event loop
+        with self._slots:
+            start = time.perf_counter()
+            response = self.session.post(url, **kwargs)
+            # Server time only: rate limiting, slot waits and retry backoff
+            # happen outside this block (read by PageSizer via _fetch_page)
+            response.post_seconds = time.perf_counter() - start
+            return response
+
+    async def _post(self, endpoint, **kwargs):
+        """
+        POST to `endpoint` through its rate limiter and circuit breaker.
+
+        429, 5xx and connection errors are retried with exponential backoff
+        (honoring Retry-After); once `max_retries` is exhausted a
+        TransientAPIError is raised instead of returning the failed response.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        url = f"{self.base_url}/{endpoint}"
+        limiter = get_rate_limiter(endpoint)
+        breaker = get_circuit_breaker(endpoint)
+
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            probe = False
+            try:
+                probe = breaker.check(endpoint)
+                await limiter.acquire()
+                response = await asyncio.to_thread(self._send, url, **kwargs)
+            except RETRY_EXCEPTIONS as e:
+                breaker.record_failure()
+                error = str(e)
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    breaker.record_success()
+                    limiter.on_success()
+                    return response
+                if response.status_code == 429:
+                    limiter.on_throttle()
+                    if probe:
+                        # A throttled probe says nothing about recovery; keep the circuit open
+                        breaker.record_failure()
+                else:
+                    breaker.record_failure()
+                retry_after = retry_after_seconds(response)
+                error = f"HTTP {response.status_code}"
+            finally:
+                if probe:
+                    # Cancelled (e.g. a prefetched page in iter_pages) or an unexpected error
+                    breaker.abandon_probe()
+
+            if attempt == self.max_retries:
+                break
+            delay = retry_after if retry_after is not None else backoff_delay(attempt)
+            self.logger.warning(
+                f"{endpoint}: {error}; retrying in {delay:.1f}s "
+                f"(attempt {attempt + 1}/{self.max_retries})"
+            )
+            await asyncio.sleep(delay)
+
+        raise TransientAPIError(
+            f"{endpoint}: {error} after {self.max_retries + 1} attempts"
+        )
+
+    async def authenticate(self, force=False):
+        """
+        Load credentials from the shared token cache, requesting a new token
+        only when none is cached or it is about to expire. With `force`, the
+        current token is known to be rejected and is replaced unless another
+        worker already did so.
+        """
+        if self.response_cache.mode == REPLAY:
+            # Offline: every page comes from the response cache
+            self.credentials = {"X-Maravi-Replay": "1"}
+            return
+
+        rejected = self.credentials if force else None
+        self.credentials = await asyncio.to_thread(self._load_credentials, rejected)
+
+    def _credentials_from_token(self, token):
+        return {
+            "CF-Access-Client-Id": self.client_id,
+            "CF-Access-Client-Secret": self.client_secret,
+            "Authorization": f"{token['token_type']} {token['access_token']}",
+        }
+
+    def _load_credentials(self, rejected=None):
+        key = self.token_cache.key(self.username, self.client_id)
+
+        token = self.token_cache.get(key)
+        if token and self._credentials_from_token(token) != rejected:
+            return self._credentials_from_token(token)
+
+        with self.token_cache.lock():
+            # Another worker may have refreshed while we waited for the lock
+            token = self.token_cache.get(key)
+            if token and self._credentials_from_token(token) != rejected:
+                return self._credentials_from_token(token)
+
+            self.logger.info("Requesting a new access token...")
+            url = f"{self.base_url}/auth/token"
+            data = {
+                "username": self.username,
+                "password": self.password,
+            }
+            client_headers = {
+                "CF-Access-Client-Id": self.client_id,
+                "CF-Access-Client-Secret": self.client_secret,
+            }
+
+            try:
+                response = self.session.post(
+                    url, data=data, headers=client_headers, timeout=self.timeout
+                )
+                response.raise_for_status()
+                token = self.token_cache.put(key, response.json())
+            except requests.exceptions.RequestException as e:
+                self.logger.error(f"Authentication failed: {str(e)}")
+                raise
+
+        return self._credentials_from_token(token)
+
+    async def fetch_page(self, endpoint, params=None, page=0, per_page=10000):
+        """Fetch a single page of `endpoint` and return the decoded JSON body."""
+        result, _, _ = await self._fetch_page(endpoint, params, page, per_page)
+        return result
+
+    async def _fetch_page(self, endpoint, params, page, per_page):
+        """
+        fetch_page, also returning the body size in bytes and the seconds
+        the answering session.post took, excluding rate limiting, slot
+        waits and retries (0 when served from the response cache).
+        """
+        if self.response_cache.mode in (USE, REPLAY):
+            # Ask for the pages as they were recorded
+            per_page = self.response_cache.per_page(endpoint, params) or per_page
+        body = self.response_cache.get(endpoint, params, page, per_page)
+        if body is not None:
+            return loads(body), len(body), 0
+
+        if not self.credentials:
+            await self.authenticate()
+
+        request_params = dict(params or {})
+        request_params["pagination"] = {
+            "per_page": per_page,
+            "page": page,
+        }
+
+        response = await self._post(endpoint, headers=self.credentials, json=request_params)
+        if response.status_code == 401:
+            # Token revoked or expired early: refresh once and retry
+            self.logger.info("Token rejected. Refreshing and retrying...")
+            await self.authenticate(force=True)
+            response = await self._post(endpoint, headers=self.credentials, json=request_params)
+        response.raise_for_status()
+        elapsed = response.post_seconds
+        self.response_cache.put(endpoint, params, page, per_page, response.content)
+        return loads(response.content), len(response.content), elapsed
+
+    def page_size(self, endpoint, default):
+        """Page size to request from `endpoint` for a whole fetch (see PageSizer)."""
+        return self.page_sizer.size(endpoint, default)
+
+    async def iter_pages(
+        self,
+        endpoint,
+        params=None,
+        key="objects",
+        per_page=10000,
+        first_page=None,
+        max_pages=None,
+        max_empty_pages=1,
+        max_rows=None,
+        max_bytes=None,
+    ):
+        """
+        Yield (page, items) for every page of `endpoint`, in page order.
+
+        Up to `max_concurrency` pages are requested ahead of the one being
+        consumed. Iteration stops after `max_empty_pages` consecutive pages
+        without data under `key`, once `max_pages` pages were requested, or
+        once `max_rows` records or `max_bytes` of response bodies were read
+        (a budget stop is logged, since the result is then incomplete).
+        `first_page` lets callers pass a page 0 they already fetched.
+        Every page fetched here feeds the endpoint's PageSizer.
+        """
+        in_flight = {}
+        ready = {}
+        next_page = 0
+        expected = 0
+        empty_pages = 0
+        total_rows = 0
+        total_bytes = 0
+
+        if first_page is not None:
+            ready[0] = (first_page, 0, 0)
+            next_page = 1
+
+        try:
+            while True:
+                while len(in_flight) + len(ready) < self.max_concurrency and (
+                    max_pages is None or next_page < max_pages
+                ):
+                    self.logger.info(f"Fetching {key} page {next_page}...")
+                    in_flight[next_page] = asyncio.ensure_future(
+                        self._fetch_page(endpoint, params, next_page, per_page)
+                    )
+                    next_page += 1
+
+                if expected not in ready:
+                    if expected not in in_flight:
+                        self.logger.info(f"Safety break at page {expected}")
+                        return
+                    await asyncio.wait(
+                        in_flight.values(), return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for page in [p for p, task in in_flight.items() if task.done()]:
+                        ready[page] = in_flight.pop(page)
+                    continue
+
+                # Errors only count for pages we actually consume, not for
+                # prefetched pages past the end
+                entry = ready.pop(expected)
+                if isinstance(entry, asyncio.Future):
+                    entry = entry.result()
+                result, nbytes, elapsed = entry
+                items = extract_items(result, key)
+                if elapsed:
+                    self.page_sizer.observe(endpoint, per_page, len(items), elapsed, nbytes)
+                if not items:
+                    self.logger.info(f"No more {key} data found at page {expected}")
+                    empty_pages += 1
+                    if empty_pages >= max_empty_pages:
+                        return
+                else:
+                    empty_pages = 0
+                    yield expected, items
+
+                total_rows += len(items)
+                total_bytes += nbytes
+                if (max_rows and total_rows >= max_rows) or (max_bytes and total_bytes >= max_bytes):
+                    self.logger.warning(
+                        f"Budget reached on {endpoint} after page {expected} "
+                        f"({total_rows} rows, {total_bytes / 1024 ** 2:.0f} MB; "
+                        f"limits {max_rows} rows, {(max_bytes or 0) / 1024 ** 2:.0f} MB); "
+                        f"remaining pages were not fetched"
+                    )
+                    return
+                expected += 1
+        finally:
+            for task in in_flight.values():
+                task.cancel()
+            for entry in ready.values():
+                if isinstance(entry, asyncio.Future) and not entry.cancelled():
+                    entry.exception()  # Mark as retrieved
+            self.page_sizer.save()
+
+    async def fetch_records(self, endpoint, params=None, key="objects", **kwargs):
+        """Collect the records of every page of `endpoint` into a single list."""
+        records = []
+        async with aclosing(self.iter_pages(endpoint, params, key, **kwargs)) as pages:
+            async for page, items in pages:
+                records.extend(items)
+                self.logger.info(f"Found {len(items)} records on page {page}")
+        return records
+
+
+class BaseMaraviAPI:
+    """
+    Synchronous facade over AsyncMaraviAPI.
+
+    Subclasses in src/api*.py implement `fetch_data` for the response shapes
+    each job expects (src/api3.py reads only through `iter_batches`); this
+    class only deals with auth and paging.
+    """
+
+    per_page = 10000  # Starting page size; paginated endpoints then adapt it
+    timeout = None  # Default read timeout in seconds (None waits forever)
+    max_rows = None  # Row budget per fetch (MARAVI_MAX_ROWS by default)
+    max_bytes = None  # Response-size budget per fetch (MARAVI_MAX_BYTES by default)
+
+    def __init__(
+        self,
+        username,
+        password,
+        client_id,
+        client_secret,
+        max_concurrency=None,
+        pool_size=None,
+        session=None,
+    ):
+        self.client = AsyncMaraviAPI(
+            username,
+            password,
+            client_id,
+            client_secret,
+            max_concurrency=max_concurrency,
+            read_timeout=self.timeout,
+            pool_size=pool_size,
+            session=session,
+        )
+        self.logger = logger
+
+    @property
+    def credentials(self):
+        return self.client.credentials
+
+    def authenticate(self, force=False):
+        run_sync(self.client.authenticate(force=force))
+
+    def page_size(self, endpoint):
+        """Page size for a paginated fetch of `endpoint`, tuned from earlier runs."""
+        return self.client.page_size(endpoint, self.per_page)
+
+    def budget(self):
+        """iter_pages keyword arguments limiting how much one fetch may read."""
+        return {
+            "max_rows": self.max_rows or int(os.getenv("MARAVI_MAX_ROWS", DEFAULT_MAX_ROWS)),
+            "max_bytes": self.max_bytes or int(os.getenv("MARAVI_MAX_BYTES", DEFAULT_MAX_BYTES)),
+        }
+
+    def fetch_page(self, endpoint, params=None, page=0, per_page=None):
+        return run_sync(
+            self.client.fetch_page(endpoint, params, page, per_page=per_page or self.per_page)
+        )
+
+    def fetch_records(self, endpoint, params=None, key="objects", **kwargs):
+        kwargs.setdefault("per_page", self.per_page)
+        kwargs = {**self.budget(), **kwargs}
+        return run_sync(self.client.fetch_records(endpoint, params, key, **kwargs))
+
+    def iter_pages(self, endpoint, params=None, key="objects", **kwargs):
+        """
+        Yield (page, items) as pages arrive instead of accumulating them.
+
+        Pages are still prefetched concurrently, but at most `max_concurrency`
+        of them are held in memory at any time.
+        """
+        if "per_page" not in kwargs:
+            kwargs["per_page"] = self.page_size(endpoint)
+        kwargs = {**self.budget(), **kwargs}
+        loop = asyncio.new_event_loop()
+        pages = self.client.iter_pages(endpoint, params, key, **kwargs)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(pages.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            loop.run_until_complete(pages.aclose())
+            loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
+
+    def iter_batches(self, endpoint, params=None, key="objects", schema=None, **kwargs):
+        """
+        Yield one DataFrame per page, typed and trimmed to `schema`
+        (see src.decoding.records_to_frame).
+        """
+        for page, items in self.iter_pages(endpoint, params, key, **kwargs):
+            self.logger.info(f"Found {len(items)} records on page {page}")
+            yield records_to_frame(items, schema)
+
+    def shards(self, params, shard_key="portfolio_ids", shard_size=None):
+        """
+        Per-shard params for a request listing many `shard_key` values, or None
+        when it fits in a single shard. `shard_size` defaults to
+        MARAVI_SHARD_SIZE; 0 disables sharding.
+        """
+        if shard_size is None:
+            shard_size = int(os.getenv("MARAVI_SHARD_SIZE", DEFAULT_SHARD_SIZE))
+        if not shard_size or not params or len(params.get(shard_key) or []) <= shard_size:
+            return None
+        return shard_params(params, shard_key, shard_size)
+
+    def fetch_shards(self, fetch_shard, shards, shard_key="portfolio_ids"):
+        """
+        Run the coroutine function `fetch_shard(params)` for every shard
+        concurrently and return the results in shard order. Each shard's
+        duration is logged so slow funds stand out.
+        """
+        return run_sync(self._gather_shards(fetch_shard, shards, shard_key))
+
+    async def _gather_shards(self, fetch_shard, shards, shard_key):
+        async def timed(number, shard):
+            start = time.perf_counter()
+            result = await fetch_shard(shard)
+            elapsed = time.perf_counter() - start
+            self.logger.info(
+                f"Shard {number}/{len(shards)} {shard_key}={shard[shard_key]}: "
+                f"{len(result)} items in {elapsed:.1f}s"
+            )
+            return result, elapsed
+
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(timed(number, shard) for number, shard in enumerate(shards, start=1))
+        )
+        slowest = max(range(len(results)), key=lambda i: results[i][1])
+        self.logger.info(
+            f"Fetched {len(shards)} shards in {time.perf_counter() - start:.1f}s; "
+            f"slowest was {shard_key}={shards[slowest][shard_key]} "
+            f"({results[slowest][1]:.1f}s)"
+        )
+        return [result for result, _ in results]
@@ -1,15 +1,45 @@
-import os
 import datetime
+import time
 import pandas as pd
 
+from src import gaps, ledger
 from src.api import MaraviAPI
-from src.calendar import TarponCalendar
+from src.calendar import get_calendar
+from src.decoding import DATETIME, INT64, NUMERIC, OBJECT, _typed_column
 from src.logger import setup_logger
-from src.db import append_to_db, get_data_from_db, table_exists
+from src.maravi import get_client
+from src.db import upsert_to_db
+from src.pipeline import prefetch
+from src.planner import run_planned
 
 logger = setup_logger(name="Movimentos")
 
-tarpon_calendar = TarponCalendar()
+JOB = "movimentos"
+TABLE = "movements"
+MOVEMENTS_ENDPOINT = "liabilities/transaction_order/get"
+
+# Colunas mantidas de cada movimentação e seus tipos, na ordem gravada na base
+MOVEMENT_SCHEMA = {
+    "id": OBJECT,
+    "portfolio_id": INT64,
+    "portfolio_name": OBJECT,
+    "investor_id": INT64,
+    "investor_name": OBJECT,
+    "distributor_id": INT64,
+    "distributor_name": OBJECT,
+    "transaction_type_description": OBJECT,
+    "net_financial_value": NUMERIC,
+    "request_date": DATETIME,
+    "conversion_date": DATETIME,
+    "payment_date": DATETIME,
+    "investor_legal_id": OBJECT,
+    "investor_legal_entity_type": OBJECT,
+    "account_group_name": OBJECT,
+    "investor_custody_account_name": OBJECT,
+    "navps": NUMERIC,
+    "shares_amount": NUMERIC,
+    "invested_book_id": OBJECT,
+}
 
 
 def append_entity_data(df, entity_type, id_column, schema="tarpon_base"):
@@ -31,116 +61,124 @@ def append_entity_data(df, entity_type, id_column, schema="tarpon_base"):
     """
     table_name = entity_type
 
-    # Verifica se a tabela existe
-    if not table_exists(table_name, schema):
-        append_to_db(df, table_name=table_name, schema=schema)
-    else:
-        # Busca dados existentes no banco
-        df_db = get_data_from_db(table_name, schema=schema)
-
-        # Identifica novos registros para inserir
-        df_to_insert = df[~df[id_column].isin(df_db[id_column].tolist())]
-
-        # Insere novos registros se existirem
-        if len(df_to_insert) > 0:
-            logger.info(f"Inserindo novos {entity_type}s no banco de dados...\n")
-            append_to_db(df_to_insert, table_name=table_name, schema=schema)
-        else:
-            logger.info(f"Nenhum novo {entity_type} para inserir\n")
-
-def batch():
-    #datas = tarpon_calendar.get_business_days_in_range(datetime.date(2006, 10, 1), datetime.date(2015, 12, 18)) #yyyy,mm,dd
-    datas = tarpon_calendar.get_business_days_in_range(datetime.date(2025, 7, 31), datetime.date(2025, 9, 25)) #yyyy,mm,dd
-    
-    for data in datas:
-        print(data.strftime("%Y-%m-%d"))
-        run(data)
-
-def run(data=None):
-    logger.info("Executando o script de movimentação...")
+    # Mescla no servidor: só o lote trafega, a tabela não é lida para o pandas
+    inserted = upsert_to_db(df, table_name, key_columns=[id_column], schema=schema)
 
-    if data is None:
-        data = tarpon_calendar.get_previous_trading_day(datetime.date.today())
-
-    logger.info("Buscando dados para: %s", data)
+    if inserted > 0:
+        logger.info(f"Inseridos {inserted} novos {entity_type}s no banco de dados\n")
+    else:
+        logger.info(f"Nenhum novo {entity_type} para inserir\n")
 
-    MARAVI_USER = os.getenv("MARAVI_USER")
-    MARAVI_PASS = os.getenv("MARAVI_PASS")
-    MARAVI_CLIENT_ID = os.getenv("MARAVI_CLIENT_ID")
-    MARAVI_CLIENT_SECRET = os.getenv("MARAVI_CLIENT_SECRET")
+def batch(start=None, end=None, force=False):
+    """
+    Backfill de `start` a `end` (por padrão, da primeira data gravada até o
+    último dia útil) que busca só as datas faltando ou incompletas.
+    """
+    datas = gaps.expected_dates(TABLE, "request_date", start, end)
+    pendentes = gaps.plan_gaps(
+        JOB, TABLE, "request_date", datas, day_payload,
+        force=force,
+    )
+    if not pendentes:
+        logger.info("Nenhuma data faltando")
+        return
 
+    m = connect()
+    run_planned(
+        pendentes,
+        MOVEMENTS_ENDPOINT,
+        fetch=lambda start, end: fetch_movements(m, start, end),
+        load=lambda df, data: load_movements(df),
+        transform=transform_movements,
+        date_column="request_date",
+        business_days=datas,
+        job=JOB,
+        payload=day_payload,
+        force=True,  # plan_gaps já consultou o run_ledger
+    )
+
+
+def connect():
     logger.info("Conectando na API...")
-    m = MaraviAPI(MARAVI_USER, MARAVI_PASS, MARAVI_CLIENT_ID, MARAVI_CLIENT_SECRET)
-    m.authenticate()
+    m = get_client(MaraviAPI)
     logger.info("Autenticado com sucesso!")
+    return m
 
-    payload = {
+
+def build_payload(start, end):
+    return {
         "include_administrator_account_group_ids_by_transaction": "true",
-        "request_start_date": data.strftime("%Y-%m-%d"),
-        "request_end_date": data.strftime("%Y-%m-%d"),
+        "request_start_date": start.strftime("%Y-%m-%d"),
+        "request_end_date": end.strftime("%Y-%m-%d"),
         "status": [3,2],
     }
-    logger.info("Buscando dados na API...")
-    df = m.fetch_data("liabilities/transaction_order/get", payload)
-    logger.info("Dados obtidos com sucesso!")
 
-    # Check if the DataFrame is empty or doesn't have the required columns
-    if df.empty:
+
+def day_payload(data):
+    """Payload da requisição de um dia; identifica a unidade no run_ledger."""
+    return build_payload(data, data)
+
+
+def fetch_movements(m, start, end):
+    """Busca todas as movimentações solicitadas entre `start` e `end` num único DataFrame."""
+    batches = [
+        df
+        for df in m.iter_batches(MOVEMENTS_ENDPOINT, build_payload(start, end), schema=MOVEMENT_SCHEMA)
+        if not df.empty
+    ]
+    return pd.concat(batches, ignore_index=True) if batches else pd.DataFrame()
+
+
+def run(data=None, force=False):
+    logger.info("Executando o script de movimentação...")
+
+    if data is None:
+        data = get_calendar().get_previous_trading_day(datetime.date.today())
+
+    logger.info("Buscando dados para: %s", data)
+
+    if ledger.is_done(JOB, data, day_payload, force):
+        logger.info(f"{JOB} de {data:%Y-%m-%d} já concluído no run_ledger; use --force para refazer")
+        return
+    started = time.perf_counter()
+
+    m = connect()
+
+    logger.info("Buscando dados na API...")
+    total_records = 0
+    # A próxima página é buscada enquanto a atual é gravada
+    for df in prefetch(m.iter_batches(MOVEMENTS_ENDPOINT, build_payload(data, data), schema=MOVEMENT_SCHEMA)):
+        if df.empty:
+            continue
+        total_records += len(df)
+        load_movements(transform_movements(df))
+
+    if total_records == 0:
         logger.info(f"Nenhum dado encontrado para a data: {data}")
+        ledger.record(JOB, data, 0, day_payload, time.perf_counter() - started)
         return
-    
-    required_columns = [
-        "id", "portfolio_id", "portfolio_name", "investor_id", "investor_name",
-        "distributor_id", "distributor_name", "transaction_type_description",
-        "net_financial_value", "request_date", "conversion_date", "payment_date",
-        "investor_legal_id", "investor_legal_entity_type", "account_group_name",
-        "investor_custody_account_name", "navps", "shares_amount", "invested_book_id"
-    ]
-    
-    # Check if all required columns exist in the DataFrame
-    missing_columns = [col for col in required_columns if col not in df.columns]
-    if missing_columns:
-        logger.warning(f"Colunas ausentes no DataFrame: {missing_columns}")
-        logger.warning("Colunas disponíveis: " + ", ".join(df.columns.tolist()))
+
+    logger.info(f"Dados obtidos com sucesso! Total de movimentações: {total_records}")
+    ledger.record(JOB, data, total_records, day_payload, time.perf_counter() - started)
+
+
+def transform_movements(df):
+    """O lote com as colunas de MOVEMENT_SCHEMA, vazias onde a página não trouxe o campo."""
+    missing = [col for col in MOVEMENT_SCHEMA if col not in df.columns]
+    if missing:
+        logger.warning(f"Colunas ausentes no lote, gravadas vazias: {missing}")
+    df = df.reindex(columns=list(MOVEMENT_SCHEMA))
+    for col in missing:
+        df[col] = _typed_column([None] * len(df), MOVEMENT_SCHEMA[col])
+    return df
+
+
+def load_movements(df):
+    """Grava um lote de movimentações e as entidades (portfolio, investor, distributor) referenciadas."""
+    if df.empty:
         return
 
     print("\n\n")
-    df = df[
-        [
-            "id",
-            "portfolio_id",
-            "portfolio_name",
-            "investor_id",
-            "investor_name",
-            "distributor_id",
-            "distributor_name",
-            "transaction_type_description",
-            "net_financial_value",
-            "request_date",
-            "conversion_date",
-            "payment_date",
-            "investor_legal_id",
-            "investor_legal_entity_type",
-            "account_group_name",
-            "investor_custody_account_name",
-            "navps",
-            "shares_amount",
-            "invested_book_id",
-        ]
-    ].copy()
-
-    numeric_columns = ["net_financial_value", "navps", "shares_amount"]
-    for col in numeric_columns:
-        df[col] = pd.to_numeric(df[col], errors="coerce")
-
-    # Convert date columns
-    date_columns = ["request_date", "conversion_date", "payment_date"]
-    for col in date_columns:
-        df[col] = pd.to_datetime(df[col], errors="coerce")
-
-    df["portfolio_id"] = df["portfolio_id"].astype("Int64")
-    df["investor_id"] = df["investor_id"].astype("Int64")
-    df["distributor_id"] = df["distributor_id"].astype("Int64")
 
     # Para portfolios:
     df_portfolio = df[["portfolio_id", "portfolio_name","invested_book_id"]].drop_duplicates()
@@ -163,4 +201,4 @@ def run(data=None):
     # Para movimentações:
     df_movements = df[df["id"].notnull()].copy()
     append_entity_data(df_movements, "movements", "id")
-    print("\n")
\ No newline at end of file
+    print("\n")
@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+import threading
+
+from src.token_cache import default_cache_dir
+
+DEFAULT_MIN_PAGE_SIZE = 500
+DEFAULT_MAX_PAGE_SIZE = 20000
+DEFAULT_TARGET_SECONDS = 5.0  # Aim for pages that take about this long
+DEFAULT_TARGET_BYTES = 16 * 1024 * 1024  # ...and are no bigger than this
+SMOOTHING = 0.5  # Weight of a new observation against the current size
+MIN_FILL = 0.5  # Pages less full than this say little about the cost per record
+
+
+class PageSizer:
+    """
+    Page size per endpoint, tuned from the latency and payload size of the
+    pages actually fetched and remembered between runs.
+
+    The size is only read when a fetch starts, so it never changes in the
+    middle of a pagination. Endpoints never fetched page by page keep the
+    caller's default.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        min_size=None,
+        max_size=None,
+        target_seconds=None,
+        target_bytes=None,
+    ):
+        self.path = path or os.path.join(default_cache_dir(), "page_sizes.json")
+        self.min_size = min_size or int(os.getenv("MARAVI_MIN_PAGE_SIZE", DEFAULT_MIN_PAGE_SIZE))
+        self.max_size = max_size or int(os.getenv("MARAVI_MAX_PAGE_SIZE", DEFAULT_MAX_PAGE_SIZE))
+        self.target_seconds = target_seconds or float(
+            os.getenv("MARAVI_PAGE_TARGET_SECONDS", DEFAULT_TARGET_SECONDS)
+        )
+        self.target_bytes = target_bytes or int(
+            os.getenv("MARAVI_PAGE_TARGET_BYTES", DEFAULT_TARGET_BYTES)
+        )
+        self.logger = logging.getLogger("MaraviAPI")
+        self._sizes = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._sizes is None:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self._sizes = json.load(f)
+            except (FileNotFoundError, ValueError):
+                self._sizes = {}
+        return self._sizes
+
+    def _clamp(self, size):
+        return int(min(self.max_size, max(self.min_size, size)))
+
+    def size(self, endpoint, default):
+        """Page size to use for the next fetch of `endpoint`."""
+        with self._lock:
+            size = self._load().get(endpoint)
+        return self._clamp(size) if size else default
+
+    def observe(self, endpoint, per_page, items, seconds, nbytes):
+        """Record one page of `items` records fetched in `seconds` with a body of `nbytes`."""
+        if items < per_page * MIN_FILL or seconds <= 0:
+            return
+
+        target = min(
+            self.target_seconds * items / seconds,
+            self.target_bytes * items / max(nbytes, 1),
+        )
+        with self._lock:
+            sizes = self._load()
+            current = sizes.get(endpoint, per_page)
+            size = self._clamp(round((1 - SMOOTHING) * current + SMOOTHING * target, -2))
+            if size != current:
+                sizes[endpoint] = size
+                self._dirty = True
+
+    def save(self):
+        """Persist the sizes learned so far, if any changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            sizes = dict(self._sizes)
+            self._dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(sizes, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            self.logger.warning(f"Could not persist page sizes: {str(e)}")
+
+
+_default_sizer = None
+_default_sizer_lock = threading.Lock()
+
+
+def get_page_sizer():
+    """Process-wide PageSizer shared by every Maravi client."""
+    global _default_sizer
+    with _default_sizer_lock:
+        if _default_sizer is None:
+            _default_sizer = PageSizer()
+        return _default_sizer
@@ -0,0 +1,239 @@
+import datetime
+
+import pandas as pd
+from sqlalchemy import text
+
+from src import db
+from src.logger import setup_logger
+from src.schema import date_predicate
+
+logger = setup_logger(name="Partições")
+
+_partitioned = {}  # (schema, tabela) -> se a tabela é particionada
+_partitions = set()  # (schema, partição) já garantidas neste processo
+
+
+def month_start(value):
+    value = pd.Timestamp(value)
+    return datetime.date(value.year, value.month, 1)
+
+
+def month_bounds(value):
+    """[início, fim) do mês de `value`."""
+    start = month_start(value)
+    end = datetime.date(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start, end
+
+
+def partition_name(table_name, value):
+    start = month_start(value)
+    return f"{table_name}_p{start:%Y_%m}"
+
+
+def _months(dates):
+    return sorted({month_start(d) for d in pd.Series(dates).dropna()})
+
+
+def is_partitioned(table_name, schema):
+    key = (schema, table_name)
+    if key not in _partitioned:
+        with db.get_engine().connect() as conn:
+            row = conn.execute(
+                text(
+                    "SELECT 1 FROM pg_partitioned_table p "
+                    "JOIN pg_class c ON c.oid = p.partrelid "
+                    "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                    "WHERE n.nspname = :schema AND c.relname = :table"
+                ),
+                {"schema": schema, "table": table_name},
+            ).first()
+        _partitioned[key] = row is not None
+    return _partitioned[key]
+
+
+def create_default_partition(conn, table_name, schema, column):
+    """
+    Partição padrão, só para linhas sem data. O CHECK deixa o ATTACH de
+    novas partições pular a varredura dela.
+    """
+    conn.execute(text(
+        f'CREATE TABLE IF NOT EXISTS "{schema}"."{table_name}_default" '
+        f'PARTITION OF "{schema}"."{table_name}" DEFAULT'
+    ))
+    conn.execute(text(
+        f'ALTER TABLE "{schema}"."{table_name}_default" '
+        f'DROP CONSTRAINT IF EXISTS "{table_name}_default_null_only", '
+        f'ADD CONSTRAINT "{table_name}_default_null_only" CHECK ("{column}" IS NULL)'
+    ))
+
+
+def _create_partition(conn, table_name, schema, month):
+    start, end = month_bounds(month)
+    name = partition_name(table_name, month)
+    conn.execute(text(
+        f'CREATE TABLE IF NOT EXISTS "{schema}"."{name}" '
+        f'PARTITION OF "{schema}"."{table_name}" '
+        f"FOR VALUES FROM ('{start}') TO ('{end}')"
+    ))
+    return name
+
+
+def ensure_partitions(table_name, schema, dates):
+    """Cria as partições mensais que faltam para as datas a gravar."""
+    missing = [
+        month for month in _months(dates)
+        if (schema, partition_name(table_name, month)) not in _partitions
+    ]
+    if not missing:
+        return
+    with db.get_engine().begin() as conn:
+        for month in missing:
+            name = _create_partition(conn, table_name, schema, month)
+            _partitions.add((schema, name))
+
+
+def convert_to_partitioned(table_name, schema, column):
+    """
+    Converte uma tabela comum em particionada por mês de `column`, numa
+    única transação. A tabela antiga fica como <tabela>_legacy para
+    conferência e pode ser apagada depois.
+    """
+    legacy = f"{table_name}_legacy"
+    with db.get_engine().begin() as conn:
+        conn.execute(text(f'ALTER TABLE "{schema}"."{table_name}" RENAME TO "{legacy}"'))
+        # Os índices continuam com os nomes da tabela antiga; renomeados, os
+        # CREATE INDEX IF NOT EXISTS das migrações criam os da particionada
+        indexes = conn.execute(
+            text("SELECT indexname FROM pg_indexes WHERE schemaname = :schema AND tablename = :table"),
+            {"schema": schema, "table": legacy},
+        ).scalars().all()
+        for index in indexes:
+            renamed = f"{legacy}{index[len(table_name):]}" if index.startswith(table_name) else f"{legacy}_{index}"
+            conn.execute(text(f'ALTER INDEX "{schema}"."{index}" RENAME TO "{renamed[:63]}"'))
+        conn.execute(text(
+            f'CREATE TABLE "{schema}"."{table_name}" '
+            f'(LIKE "{schema}"."{legacy}" INCLUDING DEFAULTS) '
+            f'PARTITION BY RANGE ("{column}")'
+        ))
+        create_default_partition(conn, table_name, schema, column)
+
+        months = conn.execute(text(
+            f'SELECT DISTINCT date_trunc(\'month\', "{column}")::date '
+            f'FROM "{schema}"."{legacy}" WHERE "{column}" IS NOT NULL'
+        )).scalars().all()
+        for month in months:
+            _partitions.add((schema, _create_partition(conn, table_name, schema, month)))
+
+        moved = conn.execute(text(
+            f'INSERT INTO "{schema}"."{table_name}" SELECT * FROM "{schema}"."{legacy}"'
+        )).rowcount
+
+    _partitioned[(schema, table_name)] = True
+    logger.info(
+        f"{schema}.{table_name} particionada por mês: {len(months)} partições, "
+        f"{moved} linhas copiadas de {legacy}"
+    )
+
+
+def _stage_indexes(conn, table_name, schema, stage):
+    """CREATE INDEX em `stage` equivalentes a cada índice da tabela particionada."""
+    rows = conn.execute(
+        text(
+            "SELECT i.indisunique, pg_get_indexdef(i.indexrelid) FROM pg_index i "
+            "WHERE i.indrelid = CAST(:table AS regclass)"
+        ),
+        {"table": f'"{schema}"."{table_name}"'},
+    ).all()
+    return [
+        f'CREATE {"UNIQUE " if unique else ""}INDEX ON "{schema}"."{stage}" '
+        f'USING {definition.split(" USING ", 1)[1]}'
+        for unique, definition in rows
+    ]
+
+
+def replace_dates(df, table_name, schema, column, dates=None):
+    """
+    Substitui, na tabela particionada, todas as linhas das datas `dates`
+    (por padrão as de `df`) pelas linhas de `df`.
+
+    Num mês sem linhas gravadas para essas datas, as novas são só
+    acrescentadas à partição. Num reprocessamento, uma tabela nova recebe
+    as linhas do mês que ficam e as novas e toma o lugar da partição
+    antiga (DETACH + DROP + ATTACH). Tudo roda numa transação por mês, com
+    a partição travada contra escritas desde a cópia das linhas mantidas
+    até a troca: quem lê vê o mês antigo ou o novo, nunca um meio-termo, e
+    nenhuma escrita concorrente se perde. Retorna o número de linhas gravadas.
+    """
+    if dates is None:
+        dates = df[column]
+    days = sorted({pd.Timestamp(d).normalize() for d in pd.Series(dates).dropna()})
+    row_months = df[column].dt.to_period("M")
+
+    target = f'"{schema}"."{table_name}"'
+    columns = list(df.columns)
+    written = 0
+
+    for month in _months(days):
+        start, end = month_bounds(month)
+        name = partition_name(table_name, month)
+        stage = f"{name}_new"
+        month_days = [d for d in days if month_start(d) == month]
+        df_month = df[row_months == pd.Period(month, "M")]
+
+        ensure_partitions(table_name, schema, [month])
+
+        with db.get_engine().begin() as conn:
+            # Leituras seguem liberadas; escritas esperam até o fim da troca
+            conn.execute(text(f'LOCK TABLE "{schema}"."{name}" IN SHARE ROW EXCLUSIVE MODE'))
+            stored = conn.execute(text(
+                f'SELECT EXISTS (SELECT 1 FROM "{schema}"."{name}" '
+                f"WHERE {date_predicate(column, month_days)})"
+            )).scalar()
+
+            if not stored:
+                # Nada a substituir: basta acrescentar as linhas novas
+                db._copy_rows(conn.connection, f'"{schema}"."{name}"', columns, db._frame_rows(df_month))
+                written += len(df_month)
+                logger.info(
+                    f"Partição {name}: {len(df_month)} linhas acrescentadas "
+                    f"para {len(month_days)} data(s)"
+                )
+                continue
+
+            conn.execute(text(f'DROP TABLE IF EXISTS "{schema}"."{stage}"'))
+            conn.execute(text(
+                f'CREATE TABLE "{schema}"."{stage}" (LIKE {target} INCLUDING DEFAULTS)'
+            ))
+            kept = conn.execute(text(
+                f'INSERT INTO "{schema}"."{stage}" SELECT * FROM "{schema}"."{name}" '
+                f"WHERE NOT {date_predicate(column, month_days)}"
+            )).rowcount
+            db._copy_rows(conn.connection, f'"{schema}"."{stage}"', columns, db._frame_rows(df_month))
+            # Os mesmos índices da tabela particionada, para o ATTACH só
+            # ligá-los em vez de construí-los
+            for statement in _stage_indexes(conn, table_name, schema, stage):
+                conn.execute(text(statement))
+            # Com o CHECK o ATTACH não precisa varrer a tabela
+            conn.execute(text(
+                f'ALTER TABLE "{schema}"."{stage}" ADD CONSTRAINT "{stage}_bounds" '
+                f"CHECK (\"{column}\" >= '{start}' AND \"{column}\" < '{end}')"
+            ))
+
+            conn.execute(text(f'ALTER TABLE {target} DETACH PARTITION "{schema}"."{name}"'))
+            conn.execute(text(f'DROP TABLE "{schema}"."{name}"'))
+            conn.execute(text(f'ALTER TABLE "{schema}"."{stage}" RENAME TO "{name}"'))
+            conn.execute(text(
+                f'ALTER TABLE {target} ATTACH PARTITION "{schema}"."{name}" '
+                f"FOR VALUES FROM ('{start}') TO ('{end}')"
+            ))
+            conn.execute(text(
+                f'ALTER TABLE "{schema}"."{name}" DROP CONSTRAINT "{stage}_bounds"'
+            ))
+
+        written += len(df_month)
+        logger.info(
+            f"Partição {name} trocada: {kept} linhas mantidas, {len(df_month)} gravadas "
+            f"para {len(month_days)} data(s)"
+        )
+    return written
+
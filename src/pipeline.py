@@ -0,0 +1,156 @@
+import os
+import queue
+import threading
+import time
+
+from src.backfill import Progress, backfill_workers
+from src.logger import setup_logger
+
+logger = setup_logger(name="Pipeline")
+
+# Itens prontos que cada fila segura antes de o estágio anterior esperar;
+# limita a memória a alguns DataFrames por estágio
+DEFAULT_DEPTH = 2
+
+_DONE = object()  # Marca o fim de uma fila
+
+
+def pipeline_depth(depth=None):
+    """Tamanho das filas: o pedido, ou PIPELINE_DEPTH, ou DEFAULT_DEPTH."""
+    return max(1, depth or int(os.getenv("PIPELINE_DEPTH", DEFAULT_DEPTH)))
+
+
+def run_pipeline(items, fetch, load, transform=None, fetchers=None, depth=None, label="pipeline"):
+    """
+    Processa `items` em três estágios ligados por filas limitadas, para a
+    busca na API sobrepor a gravação no banco.
+
+    `fetch(item)` roda em até `fetchers` threads (BACKFILL_WORKERS por
+    padrão), `transform(item, dados)` numa thread e `load(item, dados)`
+    numa thread, devolvendo o número de linhas gravadas (ou None). Quando
+    a fila de um estágio enche, o anterior espera: além dos itens em
+    processamento, no máximo `depth` ficam em memória por fila. O erro de
+    um item é registrado e o item sai do pipeline sem interromper os
+    outros. Retorna um BackfillReport.
+    """
+    items = list(items)
+    fetchers = min(backfill_workers(fetchers), max(len(items), 1))
+    depth = pipeline_depth(depth)
+    progress = Progress(label, len(items))
+    logger.info(f"{label}: {len(items)} itens, {fetchers} fetchers, filas de {depth}")
+
+    pending = queue.Queue()
+    for item in items:
+        pending.put(item)
+    fetched = queue.Queue(maxsize=depth)
+    transformed = queue.Queue(maxsize=depth)
+
+    def fail(stage, item, error):
+        logger.error(f"{label}: erro ao {stage} {item}: {error}")
+        progress.fail(item, error)
+
+    def fetcher():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                data = fetch(item)
+            except Exception as e:
+                fail("buscar", item, e)
+                continue
+            fetched.put((item, data))
+
+    def transformer():
+        while True:
+            entry = fetched.get()
+            if entry is _DONE:
+                break
+            item, data = entry
+            try:
+                if transform is not None:
+                    data = transform(item, data)
+            except Exception as e:
+                fail("transformar", item, e)
+                continue
+            transformed.put((item, data))
+        transformed.put(_DONE)
+
+    def loader():
+        while True:
+            entry = transformed.get()
+            if entry is _DONE:
+                return
+            item, data = entry
+            try:
+                progress.add_rows(load(item, data))
+            except Exception as e:
+                fail("gravar", item, e)
+
+    fetch_threads = [
+        threading.Thread(target=fetcher, name=f"{label}-fetch-{i}", daemon=True)
+        for i in range(fetchers)
+    ]
+    stages = [
+        threading.Thread(target=transformer, name=f"{label}-transform", daemon=True),
+        threading.Thread(target=loader, name=f"{label}-load", daemon=True),
+    ]
+    for thread in fetch_threads + stages:
+        thread.start()
+    for thread in fetch_threads:
+        thread.join()
+    fetched.put(_DONE)
+    for thread in stages:
+        thread.join()
+
+    return progress.report()
+
+
+def prefetch(iterable, depth=None):
+    """
+    Itera `iterable` (em geral as páginas de MaraviAPI.iter_batches) numa
+    thread à frente de quem consome, guardando até `depth` itens: a próxima
+    página é buscada enquanto a atual é tratada e gravada. Erros da busca
+    são relançados no consumidor.
+    """
+    buffer = queue.Queue(maxsize=pipeline_depth(depth))
+    stop = threading.Event()
+
+    def producer():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                buffer.put((item, None))
+        except Exception as e:
+            buffer.put((_DONE, e))
+            return
+        buffer.put((_DONE, None))
+
+    thread = threading.Thread(target=producer, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # O consumidor parou antes do fim: libera o produtor que espera na fila cheia
+        stop.set()
+        while thread.is_alive():
+            try:
+                buffer.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def timed(fetch):
+    """Envolve `fetch(item)` para devolver (início, dados), para medir o item inteiro no load."""
+    def wrapper(item):
+        started = time.perf_counter()
+        return started, fetch(item)
+    return wrapper
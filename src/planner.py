@@ -0,0 +1,226 @@
+import threading
+import time
+from collections import deque
+from typing import NamedTuple
+
+import pandas as pd
+
+from src import ledger
+from src.logger import setup_logger
+from src.pipeline import run_pipeline
+
+logger = setup_logger(name="Planner")
+
+
+class EndpointPlan(NamedTuple):
+    window_days: int  # Dias úteis por requisição
+    max_rows: int  # Acima disso a janela é dividida e buscada de novo
+
+
+# Tamanho das janelas por endpoint. O de preços não é paginado pelo cliente,
+# então uma janela que enche a página (10000) pode ter sido truncada.
+ENDPOINT_PLANS = {
+    "operations/operations/get": EndpointPlan(window_days=60, max_rows=500_000),
+    "liabilities/transaction_order/get": EndpointPlan(window_days=20, max_rows=200_000),
+    "market_data/pricing/prices/get": EndpointPlan(window_days=5, max_rows=9_999),
+}
+DEFAULT_PLAN = EndpointPlan(window_days=10, max_rows=100_000)
+
+
+class Window(NamedTuple):
+    start: pd.Timestamp
+    end: pd.Timestamp
+    dates: list
+
+
+def _window(dates):
+    return Window(dates[0], dates[-1], dates)
+
+
+def plan_windows(dates, window_days, business_days=None):
+    """
+    Agrupa as datas em janelas de até `window_days` datas consecutivas.
+
+    Com `business_days` (o calendário completo do período), uma janela só
+    cobre datas vizinhas nesse calendário, para não buscar de novo datas
+    que ficaram de fora do plano.
+    """
+    dates = sorted(pd.Timestamp(d).normalize() for d in dates)
+    if not dates:
+        return []
+
+    position = None
+    if business_days is not None:
+        position = {pd.Timestamp(d).normalize(): i for i, d in enumerate(business_days)}
+
+    windows, current = [], [dates[0]]
+    for date in dates[1:]:
+        adjacent = position is None or (
+            date in position
+            and current[-1] in position
+            and position[date] == position[current[-1]] + 1
+        )
+        if adjacent and len(current) < window_days:
+            current.append(date)
+        else:
+            windows.append(_window(current))
+            current = [date]
+    windows.append(_window(current))
+    return windows
+
+
+def split_days(df, date_column):
+    """As linhas de `df` por dia de `date_column`."""
+    if df is None or df.empty:
+        return {}
+    return dict(tuple(df.groupby(df[date_column].dt.normalize())))
+
+
+def route_rows(groups, window, load, record=None, fetch_seconds=0.0):
+    """
+    Entrega a `load(df_dia, data)` as linhas de cada data da janela
+    (`groups`, de split_days). O erro ao gravar uma data não impede as
+    outras; retorna (linhas entregues, [(data, erro)] das que falharam).
+
+    Com `record`, chama `record(data, linhas, segundos)` para cada data
+    gravada ou vazia, com a sua parte de `fetch_seconds` mais o tempo da gravação.
+    """
+    groups = dict(groups)
+    rows, failed = 0, []
+    for date in window.dates:
+        df_day = groups.pop(date, None)
+        if df_day is None or df_day.empty:
+            logger.info(f"Nenhum dado para {date:%Y-%m-%d}")
+            if record is not None:
+                record(date, 0, fetch_seconds / len(window.dates))
+            continue
+        try:
+            started = time.perf_counter()
+            load(df_day.reset_index(drop=True), date)
+            rows += len(df_day)
+            if record is not None:
+                seconds = fetch_seconds / len(window.dates) + time.perf_counter() - started
+                record(date, len(df_day), seconds)
+        except Exception as e:
+            logger.error(f"Erro ao gravar {date:%Y-%m-%d}: {e}")
+            failed.append((date, e))
+
+    leftover = sum(len(g) for g in groups.values())
+    if leftover:
+        logger.warning(f"{leftover} registros com datas fora da janela foram ignorados")
+    return rows, failed
+
+
+class _WindowSize:
+    """Tamanho máximo das janelas, reduzido quando uma delas precisa ser dividida."""
+
+    def __init__(self, days):
+        self.days = days
+        self._lock = threading.Lock()
+
+    def shrink(self, days):
+        with self._lock:
+            self.days = min(self.days, days)
+
+
+def _fetch_window(window, fetch, max_rows, size):
+    """
+    Busca a janela em partes de até `size.days` datas; uma parte que
+    retorna mais de `max_rows` linhas é dividida ao meio e buscada de novo,
+    e as janelas seguintes passam a usar o tamanho reduzido. Retorna
+    [(parte, df, segundos)].
+    """
+    parts = deque(_window(window.dates[i:i + size.days]) for i in range(0, len(window.dates), size.days))
+    fetched = []
+    while parts:
+        part = parts.popleft()
+        logger.info(f"Buscando janela {part.start:%Y-%m-%d} a {part.end:%Y-%m-%d} ({len(part.dates)} datas)")
+        started = time.perf_counter()
+        df = fetch(part.start, part.end)
+        if len(df) > max_rows and len(part.dates) > 1:
+            logger.info(f"Janela retornou {len(df)} linhas (limite {max_rows}); dividindo em duas")
+            half = len(part.dates) // 2
+            size.shrink(half)
+            parts.extendleft([_window(part.dates[half:]), _window(part.dates[:half])])
+            continue
+        fetched.append((part, df, time.perf_counter() - started))
+    return fetched
+
+
+def run_planned(
+    dates,
+    endpoint,
+    fetch,
+    load,
+    date_column="date",
+    business_days=None,
+    workers=None,
+    job=None,
+    payload=None,
+    force=False,
+    transform=None,
+    record=None,
+):
+    """
+    Busca um intervalo de datas em poucas requisições e grava dia a dia.
+
+    `fetch(start, end)` busca uma janela inteira, `transform(df)` (opcional)
+    limpa as linhas da janela e `load(df, data)` grava as linhas de uma
+    data. Os três rodam em estágios do src.pipeline: até `workers` janelas
+    (BACKFILL_WORKERS por padrão) são buscadas ao mesmo tempo enquanto as
+    anteriores são tratadas e gravadas, com filas limitadas entre os
+    estágios. Janelas que retornam mais de `max_rows` linhas são divididas
+    ao meio e buscadas de novo, e as que ainda não começaram passam a usar
+    o tamanho reduzido. Erros numa janela ou data são registrados sem
+    interromper as demais; retorna a lista de janelas que falharam (as
+    datas com erro na gravação voltam como janelas de um dia).
+
+    Com `job`, as datas já concluídas no run_ledger com o mesmo payload
+    (`payload(data)`, o payload da requisição de um dia) são puladas, a
+    menos que `force`, e cada data gravada é registrada lá; um backfill
+    interrompido recomeça da primeira data que faltou. Sem `job`,
+    `record(data, linhas, segundos)`, se dado, é chamado para cada data
+    gravada ou vazia, como em route_rows.
+    """
+    if job is not None:
+        dates = list(dates)
+        if business_days is None:
+            # Janelas não atravessam as datas puladas
+            business_days = sorted(pd.Timestamp(d).normalize() for d in dates)
+        dates = ledger.pending(job, dates, payload, force)
+
+        def record(date, rows, seconds):
+            ledger.record(job, date, rows, payload, seconds)
+
+    plan = ENDPOINT_PLANS.get(endpoint, DEFAULT_PLAN)
+    windows = plan_windows(dates, plan.window_days, business_days)
+    size = _WindowSize(plan.window_days)
+    logger.info(f"{endpoint}: {len(windows)} janelas de até {plan.window_days} dias úteis")
+
+    def transform_window(window, fetched):
+        return [
+            (part, split_days(df if transform is None or df.empty else transform(df), date_column), seconds)
+            for part, df, seconds in fetched
+        ]
+
+    failed_dates = []  # Só o estágio de gravação escreve aqui
+
+    def load_window(window, parts):
+        total = 0
+        for part, groups, seconds in parts:
+            rows, failed = route_rows(groups, part, load, record, seconds)
+            total += rows
+            failed_dates.extend(failed)
+        return total
+
+    report = run_pipeline(
+        windows,
+        fetch=lambda window: _fetch_window(window, fetch, plan.max_rows, size),
+        transform=transform_window,
+        load=load_window,
+        fetchers=workers,
+        label=endpoint,
+    )
+    if failed_dates:
+        logger.error(f"{endpoint}: {len(failed_dates)} datas com erro na gravação")
+    return [window for window, _ in report.failed] + [_window([date]) for date, _ in failed_dates]
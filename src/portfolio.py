@@ -1,13 +1,34 @@
 import datetime
-import os
+import time
 import pandas as pd
-from src.calendar import TarponCalendar
+from src import gaps, ledger
+from src.calendar import get_calendar
 from src.logger import setup_logger
-from src.db import append_to_db, get_data_from_db, table_exists, engine
+from src.maravi import get_client
+from src.pipeline import run_pipeline, timed
+from src.db import append_to_db, get_data_from_db, table_exists, get_engine
+from src.schema import date_predicate, replace_dates
 from src.api4 import MaraviAPI
 
 logger = setup_logger(name="Carteiras")
-tarpon_calendar = TarponCalendar()
+
+JOB = "portfolio"
+TABLE = "fund_portfolio"
+
+# Fundos consultados; a requisição é dividida em shards de MARAVI_SHARD_SIZE fundos
+PORTFOLIO_IDS = [875,1158,1159,1160,1576,1308,843,
+                 427,984,144,732,506,161,964,685,499,
+                 775,1298,934,1215,1299,1213,
+                 657,1211,980,616,1184,1137,1277,
+                 1212,1216,774,1303,159,1274,824,1569,
+                 653,950,879,164,505,145,1924,1987,1539]
+
+# ====== COLUNAS ESSENCIAIS COM AS NOVAS PERCENTUAIS ======
+DESIRED_COLUMNS = [
+    "date", "portfolio_name", "portfolio_id", "instrument_name", 
+    "quantity", "price", "asset_value", "book_name", "position_type",
+    "pct_net_asset_value", "pct_asset_value", "sector_name"
+]
 
 def append_portfolio_data_simple(df, entity_type="fund_portfolio", schema="tarpon_base"):
     table_name = entity_type
@@ -21,20 +42,25 @@ def append_portfolio_data_simple(df, entity_type="fund_portfolio", schema="tarpo
         logger.info(f"Tabela {table_name} criada e {len(df)} registros inseridos")
         return
 
+    # Tabela particionada: as datas são regravadas trocando a partição do mês
+    written = replace_dates(df, table_name, schema)
+    if written is not None:
+        logger.info(f"{written} registros de carteiras regravados por troca de partição")
+        return
+
     logger.info(f"Verificando {len(df)} registros da API contra a base...")
     
     dates_to_check = df['date'].dt.strftime('%Y-%m-%d').unique()
     logger.info(f"Verificando dados para as datas: {dates_to_check}")
     
-    date_filter = "', '".join(dates_to_check)
     query = f"""
     SELECT date, portfolio_name, instrument_name, asset_value, position_type
     FROM {schema}.{table_name} 
-    WHERE date::date IN ('{date_filter}')
+    WHERE {date_predicate("date", dates_to_check)}
     """
     
     try:
-        df_existing = pd.read_sql(query, engine)
+        df_existing = pd.read_sql(query, get_engine())
         logger.info(f"Encontrados {len(df_existing)} registros existentes na base")
     except Exception as e:
         logger.error(f"Erro ao buscar dados existentes: {e}")
@@ -75,72 +101,88 @@ def append_portfolio_data_simple(df, entity_type="fund_portfolio", schema="tarpo
             logger.info("Inserção concluída com sucesso!")
         except Exception as e:
             logger.error(f"Erro ao inserir dados: {e}")
+            raise
     else:
         logger.info("Nenhum registro novo para inserir")
 
-def batch():
-    """Execução em lote para múltiplas datas"""
-    datas = pd.date_range(datetime.date(2025, 10, 31), datetime.date(2025,11, 28))
-    
-    df = pd.DataFrame({'date': datas})
-    df['diff_month'] = df.date.dt.month - df.date.shift(-1).dt.month
-    df = df[df.diff_month != 0].copy()
-    
-    for date in df.date.values:
-        data = tarpon_calendar.get_last_trading_day_of_month(date)   
-        run(data)
+def batch(start=None, end=None, force=False):
+    """
+    Backfill dos fins de mês de `start` a `end` (por padrão, da primeira
+    data gravada até o último dia útil) que busca só os meses faltando ou
+    incompletos. A busca de um mês sobrepõe a gravação dos anteriores.
+    """
+    datas = gaps.expected_dates(TABLE, "date", start, end, monthly=True)
+    pendentes = gaps.plan_gaps(
+        JOB, TABLE, "date", datas, build_payload,
+        min_fraction=gaps.INCOMPLETE_FRACTION,
+        force=force,
+    )
+    if not pendentes:
+        logger.info("Nenhuma data faltando")
+        return
+
+    # plan_gaps já consultou o run_ledger
+    logger.info("Conectando na API...")
+    m = get_client(MaraviAPI)
+    run_pipeline(
+        pendentes,
+        fetch=timed(lambda data: fetch_portfolio(m, data)),
+        transform=lambda data, fetched: (fetched[0], transform_portfolio(fetched[1])),
+        load=lambda data, ready: load_portfolio(ready[1], data, ready[0]),
+        label="carteiras",
+    )
+
+
+def build_payload(data):
+    datef = data.strftime("%Y-%m-%d")
+    return {
+        "start_date": datef,
+        "end_date": datef,
+        "instrument_position_aggregation": 3,
+        "portfolio_ids": PORTFOLIO_IDS,
+    }
+
 
-def run(data=None):
+def run(data=None, shard_size=None, force=False):
     logger.info("Executando o script de carteiras...")
 
     if data is None:
-        data = tarpon_calendar.get_previous_trading_day(datetime.date.today())
+        data = get_calendar().get_previous_trading_day(datetime.date.today())
 
     logger.info("Buscando dados para: %s", data)
 
-    MARAVI_USER = os.getenv("MARAVI_USER")
-    MARAVI_PASS = os.getenv("MARAVI_PASS")
-    MARAVI_CLIENT_ID = os.getenv("MARAVI_CLIENT_ID")
-    MARAVI_CLIENT_SECRET = os.getenv("MARAVI_CLIENT_SECRET")
+    if ledger.is_done(JOB, data, build_payload, force):
+        logger.info(f"{JOB} de {data:%Y-%m-%d} já concluído no run_ledger; use --force para refazer")
+        return
+    started = time.perf_counter()
 
     logger.info("Conectando na API...")
-    m = MaraviAPI(MARAVI_USER, MARAVI_PASS, MARAVI_CLIENT_ID, MARAVI_CLIENT_SECRET)
-    m.authenticate()
+    m = get_client(MaraviAPI)
+
+    df = fetch_portfolio(m, data, shard_size)
+    return load_portfolio(transform_portfolio(df), data, started)
+
+
+def fetch_portfolio(m, data, shard_size=None):
+    params = build_payload(data)
 
-    datef = data.strftime("%Y-%m-%d")
-    params = {
-        "start_date": datef,
-        "end_date": datef,
-        "instrument_position_aggregation": 3,
-        "portfolio_ids": [875,1158,1159,1160,1576,1308,843,
-            427,984,144,732,506,161,964,685,499,
-            775,1298,934,1215,1299,1213,
-            657,1211,980,616,1184,1137,1277,
-            1212,1216,774,1303,159,1274,824,1569,
-            653,950,879,164,505,145,1924,1987,1539]
-    }
-    
     logger.info("Buscando dados na API...")
-    df = m.fetch_data("portfolio_position/positions/get", params)
+    df = m.fetch_data("portfolio_position/positions/get", params, columns=DESIRED_COLUMNS, shard_size=shard_size)
     logger.info("Dados obtidos com sucesso!")
+    return df
 
+
+def transform_portfolio(df):
+    """Carteira tipada e agregada por instrumento."""
     if df.empty:
-        logger.info("Nenhum dado encontrado")
-        return
+        return df
 
     logger.info(f"Processando {len(df)} registros da API...")
     logger.info(f"Positions: {len(df[df['position_type'] == 'POSITION'])}")
     logger.info(f"Provisions: {len(df[df['position_type'] == 'PROVISION'])}")
 
-    # ====== COLUNAS ESSENCIAIS COM AS NOVAS PERCENTUAIS ======
-    desired_columns = [
-        "date", "portfolio_name", "portfolio_id", "instrument_name", 
-        "quantity", "price", "asset_value", "book_name", "position_type",
-        "pct_net_asset_value", "pct_asset_value", "sector_name"
-    ]
-    
     # Filtrar apenas colunas que existem
-    available_columns = [col for col in desired_columns if col in df.columns]
+    available_columns = [col for col in DESIRED_COLUMNS if col in df.columns]
     logger.info(f"Usando {len(available_columns)} colunas essenciais")
     df = df[available_columns].copy()
 
@@ -179,8 +221,18 @@ def run(data=None):
     logger.info(f"Provisions agregadas: {len(df_aggregated[df_aggregated['position_type'] == 'PROVISION'])}")
 
     # Filtrar registros válidos
-    df_valid = df_aggregated[df_aggregated["date"].notnull()].copy()
-    
+    return df_aggregated[df_aggregated["date"].notnull()].copy()
+
+
+def load_portfolio(df_valid, data, started):
+    """Grava a carteira de `data` e registra no run_ledger o tempo desde `started`."""
+    if df_valid.empty:
+        logger.info("Nenhum dado encontrado")
+        ledger.record(JOB, data, 0, build_payload, time.perf_counter() - started)
+        return 0
+
     logger.info(f"Registros válidos: {len(df_valid)}")
     append_portfolio_data_simple(df_valid)
-    logger.info("Processo concluído!")
\ No newline at end of file
+    logger.info("Processo concluído!")
+    ledger.record(JOB, data, len(df_valid), build_payload, time.perf_counter() - started)
+    return len(df_valid)
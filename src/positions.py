@@ -1,16 +1,29 @@
-import os
 import datetime
+import time
 import pandas as pd
 import numpy as np
 
+from src import gaps, ledger
 from src.api2 import MaraviAPI
-from src.calendar import TarponCalendar
+from src.calendar import get_calendar
 from src.logger import setup_logger
-from src.db import append_to_db, get_data_from_db, table_exists, engine
+from src.maravi import get_client
+from src.pipeline import run_pipeline, timed
+from src.db import append_to_db, get_data_from_db, table_exists, get_engine
+from src.schema import date_predicate, replace_dates
 
 logger = setup_logger(name="Posições")
 
-tarpon_calendar = TarponCalendar()
+JOB = "positions"
+TABLE = "positions"
+
+# Fundos consultados; a requisição é dividida em shards de MARAVI_SHARD_SIZE fundos
+PORTFOLIO_IDS = [875,1158,1159,1160,1576,1308,843,
+                 427,984,144,732,506,161,964,685,499,
+                 775,1298,934,1215,1299,1213,
+                 657,1211,980,616,1184,1137,1277,
+                 1212,1216,774,1303,159,1274,824,1569,
+                 653,950,879,164,505,145,1924,1987,1539]
 
 
 def append_positions_data_simple(df, entity_type="positions", schema="tarpon_base"):
@@ -30,23 +43,28 @@ def append_positions_data_simple(df, entity_type="positions", schema="tarpon_bas
         logger.info(f"Tabela {table_name} criada e {len(df)} registros inseridos")
         return
 
+    # Tabela particionada: as datas são regravadas trocando a partição do mês
+    written = replace_dates(df, table_name, schema)
+    if written is not None:
+        logger.info(f"{written} registros de posições regravados por troca de partição")
+        return
+
     logger.info(f"Verificando {len(df)} registros da API contra a base...")
     
     # Buscar apenas os dados da mesma data que estamos tentando inserir
     dates_to_check = df['date'].dt.strftime('%Y-%m-%d').unique()
     logger.info(f"Verificando dados para as datas: {dates_to_check}")
     
-    # Criar query para buscar registros existentes da mesma data
-    date_filter = "', '".join(dates_to_check)
+    # Criar query para buscar registros existentes da mesma data (intervalos que usam o índice de date)
     query = f"""
     SELECT portfolio_name, date, investor_names, distributor_name, account_group_names,
            shares_amount, financial_value, participation_in_portfolio
     FROM {schema}.{table_name} 
-    WHERE date::date IN ('{date_filter}')
+    WHERE {date_predicate("date", dates_to_check)}
     """
     
     try:
-        df_existing = pd.read_sql(query, engine)
+        df_existing = pd.read_sql(query, get_engine())
         logger.info(f"Encontrados {len(df_existing)} registros existentes na base para essas datas")
     except Exception as e:
         logger.error(f"Erro ao buscar dados existentes: {e}")
@@ -99,6 +117,7 @@ def append_positions_data_simple(df, entity_type="positions", schema="tarpon_bas
             logger.info("✓ Inserção concluída com sucesso!")
         except Exception as e:
             logger.error(f"Erro ao inserir dados: {e}")
+            raise
     else:
         logger.info("Nenhum registro novo para inserir")
 
@@ -143,45 +162,43 @@ def check_data_quality(df):
     return df
 
 
-def batch():
-    """Execução em lote para múltiplas datas"""
-    datas = pd.date_range(datetime.date(2025, 8, 30), datetime.date(2025, 8, 31))
-    
-    df = pd.DataFrame({'date': datas})
-    df['diff_month'] = df.date.dt.month - df.date.shift(-1).dt.month
-    df = df[df.diff_month != 0].copy()
-    
-    for date in df.date.values:
-        data = tarpon_calendar.get_last_trading_day_of_month(date)   
-        run(data)
-
-
-def run(data=None):
-    """Função principal para executar coleta de posições"""
-    if data:
-        logger.info("Executando o script de posições para a data %s ...", data)
-    else:
-        logger.info("Executando o script de posições...")
-
-    if data is None:
-        data = tarpon_calendar.get_last_trading_day_of_previous_month(datetime.date.today())
+def batch(start=None, end=None, force=False):
+    """
+    Backfill dos fins de mês de `start` a `end` (por padrão, da primeira
+    data gravada até o último dia útil) que busca só os meses faltando ou
+    incompletos. A busca de um mês sobrepõe a gravação dos anteriores.
+    """
+    datas = gaps.expected_dates(TABLE, "date", start, end, monthly=True)
+    pendentes = gaps.plan_gaps(
+        JOB, TABLE, "date", datas, build_payload,
+        min_fraction=gaps.INCOMPLETE_FRACTION,
+        force=force,
+    )
+    if not pendentes:
+        logger.info("Nenhuma data faltando")
+        return
 
-    logger.info("Buscando dados para: %s", data)
+    # plan_gaps já consultou o run_ledger
+    m = connect()
+    run_pipeline(
+        pendentes,
+        fetch=timed(lambda data: fetch_positions(m, data)),
+        transform=lambda data, fetched: (fetched[0], transform_positions(fetched[1])),
+        load=lambda data, ready: load_positions(ready[1], data, ready[0]),
+        label="posições",
+    )
 
-    # Carregar credenciais
-    MARAVI_USER = os.getenv("MARAVI_USER")
-    MARAVI_PASS = os.getenv("MARAVI_PASS")
-    MARAVI_CLIENT_ID = os.getenv("MARAVI_CLIENT_ID")
-    MARAVI_CLIENT_SECRET = os.getenv("MARAVI_CLIENT_SECRET")
 
-    # Conectar na API
+def connect():
+    # Conectar na API (credenciais MARAVI_* do ambiente)
     logger.info("Conectando na API...")
-    m = MaraviAPI(MARAVI_USER, MARAVI_PASS, MARAVI_CLIENT_ID, MARAVI_CLIENT_SECRET)
-    m.authenticate()
+    m = get_client(MaraviAPI)
     logger.info("Autenticado com sucesso!")
+    return m
 
-    # Preparar payload
-    payload = {
+
+def build_payload(data):
+    return {
         "start_date": data.strftime("%Y-%m-%d"),
         #"start_date": "2023-01-31",
         "end_date": data.strftime("%Y-%m-%d"),
@@ -190,26 +207,45 @@ def run(data=None):
         "include_profitability": "true",
         "include_inactive_records": "false",
         "aggregation_mode": 6,
-        "portfolio_ids": [875,1158,1159,1160,1576,1308,843,
-                        427,984,144,732,506,161,964,685,499,
-                        775,1298,934,1215,1299,1213,
-                        657,1211,980,616,1184,1137,1277,
-                        1212,1216,774,1303,159,1274,824,1569,
-                        653,950,879,164,505,145,1924,1987,1539
-                    ],
+        "portfolio_ids": PORTFOLIO_IDS,
         "include_inactive_records": "true"
     }
-    
-    # Buscar dados da API
+
+
+def run(data=None, shard_size=None, force=False):
+    """Função principal para executar coleta de posições"""
+    if data:
+        logger.info("Executando o script de posições para a data %s ...", data)
+    else:
+        logger.info("Executando o script de posições...")
+
+    if data is None:
+        data = get_calendar().get_last_trading_day_of_previous_month(datetime.date.today())
+
+    logger.info("Buscando dados para: %s", data)
+
+    if ledger.is_done(JOB, data, build_payload, force):
+        logger.info(f"{JOB} de {data:%Y-%m-%d} já concluído no run_ledger; use --force para refazer")
+        return
+    started = time.perf_counter()
+
+    m = connect()
+    df = fetch_positions(m, data, shard_size)
+    return load_positions(transform_positions(df), data, started)
+
+
+def fetch_positions(m, data, shard_size=None):
     logger.info("Buscando dados na API...")
-    df = m.fetch_data("liabilities/position/get", payload)
+    df = m.fetch_data("liabilities/position/get", build_payload(data), shard_size=shard_size)
     logger.info("Dados obtidos com sucesso!")
+    return df
 
-    # Verificar se dados foram retornados
+
+def transform_positions(df):
+    """Posições limpas e tipadas, sem duplicatas internas; ValueError se faltam colunas."""
     if df.empty:
-        logger.info(f"Nenhum dado encontrado para a data: {data}")
-        return
-    
+        return df
+
     # Verificar colunas obrigatórias
     required_columns = [
         "date", "shares_amount", "distributor_name", "investor_names", "financial_value",
@@ -218,16 +254,16 @@ def run(data=None):
     
     missing_columns = [col for col in required_columns if col not in df.columns]
     if missing_columns:
-        logger.warning(f"Colunas ausentes no DataFrame: {missing_columns}")
+        # A API devolveu linhas sem as colunas esperadas: falha em vez de
+        # registrar o dia como vazio no run_ledger
         logger.warning("Colunas disponíveis: " + ", ".join(df.columns.tolist()))
-        return
+        raise ValueError(f"Colunas ausentes no DataFrame: {missing_columns}")
 
     # Selecionar e processar colunas
     logger.info(f"Processando {len(df)} registros da API...")
     df = df[required_columns].copy()
 
     # Converter tipos de dados
-# Converter tipos de dados
     numeric_columns = ["shares_amount", "financial_value", "participation_in_portfolio"]
     for col in numeric_columns:
         df[col] = pd.to_numeric(df[col], errors="coerce")
@@ -255,15 +291,24 @@ def run(data=None):
     df_clean = check_data_quality(df)
     
     # Filtrar registros válidos
-    df_positions = df_clean[df_clean["date"].notnull()].copy()
-    
+    return df_clean[df_clean["date"].notnull()].copy()
+
+
+def load_positions(df_positions, data, started):
+    """Grava as posições de `data` e registra no run_ledger o tempo desde `started`."""
+    if df_positions.empty:
+        logger.info(f"Nenhum dado encontrado para a data: {data}")
+        ledger.record(JOB, data, 0, build_payload, time.perf_counter() - started)
+        return 0
+
     logger.info(f"Registros válidos para inserção: {len(df_positions)}")
     
     # Inserir dados usando a função simplificada
     append_positions_data_simple(df_positions)
     
     logger.info(" Processo concluído!")
-
+    ledger.record(JOB, data, len(df_positions), build_payload, time.perf_counter() - started)
+    return len(df_positions)
 
 if __name__ == "__main__":
     run()
\ No newline at end of file
@@ -1,15 +1,27 @@
-import os
-import datetime
-import pandas as pd
-
+from src import gaps
 from src.api import MaraviAPI
-from src.calendar import TarponCalendar
+from src.decoding import DATETIME, INT64, NUMERIC, OBJECT
 from src.logger import setup_logger
-from src.db import append_to_db, get_data_from_db, table_exists
+from src.maravi import get_client
+from src.db import upsert_to_db
+from src.planner import run_planned
 
 logger = setup_logger(name="Preços")
 
-tarpon_calendar = TarponCalendar()
+JOB = "precos"
+TABLE = "precos"
+PRICES_ENDPOINT = "market_data/pricing/prices/get"
+
+# Colunas mantidas de cada preço e seus tipos
+PRICE_SCHEMA = {
+    "id": OBJECT,
+    "instrument_id": INT64,
+    "date": DATETIME,
+    "adjusted_price": NUMERIC,
+    "price": NUMERIC,
+    "currency_prefix": OBJECT,
+    "instrument": OBJECT,
+}
 
 
 def append_entity_data(df, entity_type, id_column, schema="tarpon_base"):
@@ -31,97 +43,82 @@ def append_entity_data(df, entity_type, id_column, schema="tarpon_base"):
     """
     table_name = entity_type
 
-    # Verifica se a tabela existe
-    if not table_exists(table_name, schema):
-        append_to_db(df, table_name=table_name, schema=schema)
+    # Mescla no servidor: só o lote trafega, a tabela não é lida para o pandas
+    inserted = upsert_to_db(df, table_name, key_columns=[id_column], schema=schema)
+
+    if inserted > 0:
+        logger.info(f"Inseridos {inserted} novos {entity_type}s no banco de dados\n")
     else:
-        # Busca dados existentes no banco
-        df_db = get_data_from_db(table_name, schema=schema)
+        logger.info(f"Nenhum novo {entity_type} para inserir\n")
 
-        # Identifica novos registros para inserir
-        df_to_insert = df[~df[id_column].isin(df_db[id_column].tolist())]
+def batch(start=None, end=None, force=False):
+    """
+    Backfill de `start` a `end` (por padrão, da primeira data gravada até o
+    último dia útil) que busca só as datas faltando ou incompletas.
+    """
+    datas = gaps.expected_dates(TABLE, "date", start, end)
+    pendentes = gaps.plan_gaps(
+        JOB, TABLE, "date", datas, day_payload,
+        min_fraction=gaps.INCOMPLETE_FRACTION,
+        force=force,
+    )
+    if not pendentes:
+        logger.info("Nenhuma data faltando")
+        return
 
-        # Insere novos registros se existirem
-        if len(df_to_insert) > 0:
-            logger.info(f"Inserindo novos {entity_type}s no banco de dados...\n")
-            append_to_db(df_to_insert, table_name=table_name, schema=schema)
-        else:
-            logger.info(f"Nenhum novo {entity_type} para inserir\n")
+    m = connect()
+    run_planned(
+        pendentes,
+        PRICES_ENDPOINT,
+        fetch=lambda start, end: fetch_prices(m, start, end),
+        load=load_prices,
+        transform=transform_prices,
+        date_column="date",
+        business_days=datas,
+        job=JOB,
+        payload=day_payload,
+        force=True,  # plan_gaps já consultou o run_ledger
+    )
+
+
+def connect():
+    logger.info("Conectando na API...")
+    m = get_client(MaraviAPI)
+    logger.info("Autenticado com sucesso!")
+    return m
 
-def batch():
-    datas = tarpon_calendar.get_business_days_in_range(datetime.date(2025, 8, 19), datetime.date(2025, 8, 19)) #yyyy,mm,dd
-    
-    for data in datas:
-        #print(data)
-        run(data)
 
-def run(data=None):
-    logger.info("Executando o script de preços...")
+def build_payload(start, end):
+    return {
+        "instrument_types": [2, 3, 4, 5, 6],
+        "start_date": start.strftime("%Y-%m-%d"),
+        "end_date": end.strftime("%Y-%m-%d"),
+    }
 
-    if data is None:
-        data = tarpon_calendar.get_previous_trading_day(datetime.date.today())
 
-    logger.info("Buscando dados para: %s", data)
+def day_payload(data):
+    """Payload da requisição de um dia; identifica a unidade no run_ledger."""
+    return build_payload(data, data)
 
-    MARAVI_USER = os.getenv("MARAVI_USER")
-    MARAVI_PASS = os.getenv("MARAVI_PASS")
-    MARAVI_CLIENT_ID = os.getenv("MARAVI_CLIENT_ID")
-    MARAVI_CLIENT_SECRET = os.getenv("MARAVI_CLIENT_SECRET")
 
-    logger.info("Conectando na API...")
-    m = MaraviAPI(MARAVI_USER, MARAVI_PASS, MARAVI_CLIENT_ID, MARAVI_CLIENT_SECRET)
-    m.authenticate()
-    logger.info("Autenticado com sucesso!")
-    
-    payload = {
-        "instrument_types": [2, 3, 4, 5, 6],
-        "start_date": data.strftime("%Y-%m-%d"),
-        "end_date": data.strftime("%Y-%m-%d"),
-    }
-    logger.info("Buscando dados na API...")
-    df = m.fetch_data("market_data/pricing/prices/get", payload)
-    logger.info("Dados obtidos com sucesso!")
-    
-    # Check if the DataFrame is empty or doesn't have the required columns
+def fetch_prices(m, start, end):
+    return m.fetch_data(PRICES_ENDPOINT, build_payload(start, end), schema=PRICE_SCHEMA)
+
+
+def transform_prices(df):
+    """Linhas de preço válidas; ValueError se faltam colunas."""
     if df.empty:
-        logger.info(f"Nenhum dado de preço encontrado para a data: {data}")
-        return
-    
-    required_columns = [
-        "id", "instrument_id", "date", "adjusted_price", "price",
-        "currency_prefix", "instrument"
-    ]
-    
+        return df
+
+    required_columns = list(PRICE_SCHEMA)
+
     # Check if all required columns exist in the DataFrame
     missing_columns = [col for col in required_columns if col not in df.columns]
     if missing_columns:
-        logger.warning(f"Colunas ausentes no DataFrame: {missing_columns}")
+        # A API devolveu linhas sem as colunas esperadas: falha em vez de
+        # registrar o dia como vazio no run_ledger
         logger.warning("Colunas disponíveis: " + ", ".join(df.columns.tolist()))
-        return
-        
-    print("\n\n")
-    df = df[
-        [
-            "id",
-            "instrument_id",
-            "date",
-            "adjusted_price",
-            "price",
-            "currency_prefix",
-            "instrument",
-        ]
-    ].copy()
-
-    numeric_columns = ["adjusted_price", "price"]
-    for col in numeric_columns:
-        df[col] = pd.to_numeric(df[col], errors="coerce")
-
-    # Convert date columns
-    date_columns = ["date"]
-    for col in date_columns:
-        df[col] = pd.to_datetime(df[col], errors="coerce")
-
-    df["instrument_id"] = df["instrument_id"].astype("Int64")
+        raise ValueError(f"Colunas ausentes no DataFrame: {missing_columns}")
 
     # Para precos:
     #df_precos = df[["instrument_id", "date","adjusted_price","price","currency_prefix","instrument"]].drop_duplicates()
@@ -129,6 +126,14 @@ def run(data=None):
     #append_entity_data(df_precos, "precos", "instrument_id")
     #print("\n")
 
-    df_precos = df[df["id"].notnull()].copy()
-    append_entity_data(df_precos, "precos", "id")
+    return df[df["id"].notnull()].copy()
+
+
+def load_prices(df, data):
+    if df.empty:
+        logger.info(f"Nenhum dado de preço encontrado para a data: {data}")
+        return
+
+    print("\n\n")
+    append_entity_data(df, "precos", "id")
     print("\n")
\ No newline at end of file
@@ -0,0 +1,156 @@
+import datetime
+import time
+
+import pandas as pd
+
+from src import gaps, ledger, plfund, precos
+from src.calendar import get_calendar
+from src.decoding import INT64
+from src.logger import setup_logger
+from src.planner import run_planned
+
+logger = setup_logger(name="Preços e PLs")
+
+FUND_INSTRUMENT_TYPE = 3  # O tipo que plfund pede à API
+
+# Colunas de preços e de PLs, mais o tipo do instrumento para separar os fundos
+PRICING_SCHEMA = {
+    **precos.PRICE_SCHEMA,
+    **plfund.FUND_PL_SCHEMA,
+    "instrument_type": INT64,
+}
+
+
+def fetch_pricing(m, start, end):
+    """
+    Preços de todos os tipos de instrumento de precos, que incluem os fundos
+    de plfund. Se a API não devolve o instrument_type, os fundos vêm de uma
+    segunda busca só do tipo de plfund e substituem as mesmas linhas.
+    """
+    df = m.fetch_data(
+        precos.PRICES_ENDPOINT, precos.build_payload(start, end), schema=PRICING_SCHEMA
+    )
+    if df.empty or "instrument_type" in df.columns:
+        return df
+
+    logger.warning("API não devolveu instrument_type; buscando os fundos separadamente")
+    funds = m.fetch_data(
+        precos.PRICES_ENDPOINT, plfund.build_payload(start, end), schema=PRICING_SCHEMA
+    )
+    others = df.assign(instrument_type=pd.NA)
+    if funds.empty:
+        return others.astype({"instrument_type": INT64})
+    others = others[~others["id"].isin(funds["id"])]
+    funds = funds.assign(instrument_type=FUND_INSTRUMENT_TYPE)
+    return pd.concat([others, funds], ignore_index=True).astype({"instrument_type": INT64})
+
+
+def fund_rows(df):
+    """Linhas dos fundos, pelo instrument_type que fetch_pricing garante."""
+    if df.empty:
+        return df
+    if "instrument_type" not in df.columns:
+        raise ValueError("Preços sem instrument_type: não há como separar os fundos")
+    return df[df["instrument_type"].eq(FUND_INSTRUMENT_TYPE).fillna(False)]
+
+
+def _columns(df, schema):
+    return df[[col for col in schema if col in df.columns]]
+
+
+# Jobs alimentados por uma busca: (job, payload de um dia, colunas, linhas do job, transform, load)
+FANOUT = [
+    (precos.JOB, precos.day_payload, precos.PRICE_SCHEMA, None, precos.transform_prices, precos.load_prices),
+    (plfund.JOB, plfund.day_payload, plfund.FUND_PL_SCHEMA, fund_rows, plfund.transform_fund_pls, plfund.load_fund_pls),
+]
+
+
+def fan_out(df, data, jobs=None, started=None):
+    """
+    Entrega as linhas de `data` a cada job (todos, por padrão) com as suas
+    colunas e filtros e registra cada job no run_ledger, mesmo com zero
+    linhas: a busca deu certo e o dia não tem dados dele. Retorna o total
+    de linhas gravadas.
+    """
+    jobs = set(jobs or [job for job, *_ in FANOUT])
+    total = 0
+    for job, payload, schema, select, transform, load in FANOUT:
+        if job not in jobs:
+            continue
+        job_started = time.perf_counter() if started is None else started
+        df_job = transform(_columns(df if select is None else select(df), schema))
+        load(df_job, data)
+        ledger.record(job, data, len(df_job), payload, time.perf_counter() - job_started)
+        total += len(df_job)
+    return total
+
+
+def record_empty(jobs):
+    """
+    `record` de run_planned para a busca conjunta: registra no run_ledger,
+    com zero linhas, os jobs de `jobs[data]` de um dia sem dados. Os dias
+    com dados já são registrados por fan_out.
+    """
+    def record(data, rows, seconds):
+        if rows:
+            return
+        for job, payload, *_ in FANOUT:
+            if job in jobs[data]:
+                ledger.record(job, data, 0, payload, seconds)
+    return record
+
+
+def run(data=None, force=False):
+    """Preços e PLs de fundos do dia numa única busca em market_data/pricing/prices/get."""
+    logger.info("Executando o script de preços e PLs...")
+
+    if data is None:
+        data = get_calendar().get_previous_trading_day(datetime.date.today())
+
+    logger.info("Buscando dados para: %s", data)
+
+    jobs = [job for job, payload, *_ in FANOUT if not ledger.is_done(job, data, payload, force)]
+    if not jobs:
+        logger.info(f"Preços e PLs de {data:%Y-%m-%d} já concluídos no run_ledger; use --force para refazer")
+        return
+    started = time.perf_counter()
+
+    m = precos.connect()
+
+    logger.info("Buscando dados na API...")
+    df = fetch_pricing(m, data, data)
+    logger.info("Dados obtidos com sucesso!")
+    return fan_out(df, data, jobs, started)
+
+
+def batch(start=None, end=None, force=False):
+    """
+    Backfill de `start` a `end` de preços e PLs juntos: busca uma vez as
+    datas que faltam ou estão incompletas em qualquer das duas tabelas.
+    """
+    datas = gaps.expected_dates(precos.TABLE, "date", start, end)
+    pendentes = {}  # data -> jobs que precisam dela
+    for job, table, payload in [
+        (precos.JOB, precos.TABLE, precos.day_payload),
+        (plfund.JOB, plfund.TABLE, plfund.day_payload),
+    ]:
+        for date in gaps.plan_gaps(
+            job, table, "date", datas, payload,
+            min_fraction=gaps.INCOMPLETE_FRACTION,
+            force=force,
+        ):
+            pendentes.setdefault(date, set()).add(job)
+    if not pendentes:
+        logger.info("Nenhuma data faltando")
+        return
+
+    m = precos.connect()
+    run_planned(
+        sorted(pendentes),
+        precos.PRICES_ENDPOINT,
+        fetch=lambda start, end: fetch_pricing(m, start, end),
+        load=lambda df, data: fan_out(df, data, pendentes[data]),
+        date_column="date",
+        business_days=datas,
+        record=record_empty(pendentes),
+    )
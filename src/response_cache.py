@@ -0,0 +1,160 @@
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from src.token_cache import default_cache_dir
+
+OFF = "off"  # Always call the API
+USE = "use"  # Serve fresh cached pages, fetch and store the rest
+RECORD = "record"  # Always call the API and store every page
+REPLAY = "replay"  # Serve only from the cache, never touching the network
+MODES = (OFF, USE, RECORD, REPLAY)
+
+DEFAULT_TTL = 3600  # Seconds a page of a still-open period stays fresh
+DEFAULT_CLOSED_AFTER_DAYS = 7  # Periods ending longer ago than this never expire
+
+# Payload fields holding the last date a request covers
+END_DATE_FIELDS = ("end_date", "request_end_date", "date")
+
+
+class CacheMissError(Exception):
+    """A page was requested in replay mode but is not in the cache."""
+
+
+def canonical_payload(params):
+    """Stable JSON text for a request payload (sorted keys, no whitespace)."""
+    return json.dumps(params or {}, sort_keys=True, separators=(",", ":"), default=str)
+
+
+def request_key(endpoint, params):
+    """Content address of a request: sha256 of the endpoint and canonical payload."""
+    text = f"{endpoint}\n{canonical_payload(params)}"
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _period_end(params):
+    for field in END_DATE_FIELDS:
+        value = (params or {}).get(field)
+        if value:
+            try:
+                return datetime.date.fromisoformat(str(value)[:10])
+            except ValueError:
+                return None
+    return None
+
+
+class ResponseCache:
+    """
+    Raw Maravi response bodies stored gzip-compressed on disk.
+
+    Each request (endpoint + canonical payload) gets a directory holding one
+    file per page and page size, plus a meta.json recording the page size
+    last used, so replays ask for the same pages that were recorded.
+    Pages of periods that closed more than `closed_after_days` ago never
+    expire; other pages are fresh for `ttl` seconds.
+    """
+
+    def __init__(self, root=None, mode=None, ttl=None, closed_after_days=None):
+        self.root = root or os.path.join(default_cache_dir(), "responses")
+        self.mode = (mode or os.getenv("MARAVI_CACHE_MODE") or OFF).lower()
+        if self.mode not in MODES:
+            raise ValueError(f"Unknown cache mode {self.mode!r}; expected one of {MODES}")
+        self.ttl = ttl or float(os.getenv("MARAVI_CACHE_TTL", DEFAULT_TTL))
+        self.closed_after_days = (
+            closed_after_days
+            if closed_after_days is not None
+            else int(os.getenv("MARAVI_CACHE_CLOSED_AFTER_DAYS", DEFAULT_CLOSED_AFTER_DAYS))
+        )
+        self.logger = logging.getLogger("MaraviAPI")
+
+    @property
+    def enabled(self):
+        return self.mode != OFF
+
+    def _request_dir(self, endpoint, params):
+        key = request_key(endpoint, params)
+        return os.path.join(self.root, key[:2], key)
+
+    def _page_path(self, endpoint, params, page, per_page):
+        return os.path.join(self._request_dir(endpoint, params), f"{per_page}-{page}.json.gz")
+
+    def _is_closed(self, params):
+        end = _period_end(params)
+        cutoff = datetime.date.today() - datetime.timedelta(days=self.closed_after_days)
+        return end is not None and end < cutoff
+
+    def per_page(self, endpoint, params):
+        """Page size recorded for this request, or None."""
+        try:
+            with open(os.path.join(self._request_dir(endpoint, params), "meta.json"), encoding="utf-8") as f:
+                return json.load(f)["per_page"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def get(self, endpoint, params, page, per_page):
+        """
+        Cached body of a page, or None when it must be fetched. In replay
+        mode a missing page raises CacheMissError instead.
+        """
+        if self.mode in (OFF, RECORD):
+            return None
+
+        path = self._page_path(endpoint, params, page, per_page)
+        try:
+            if self.mode == USE and not self._is_closed(params):
+                if time.time() - os.path.getmtime(path) > self.ttl:
+                    return None
+            with open(path, "rb") as f:
+                return gzip.decompress(f.read())
+        except FileNotFoundError:
+            if self.mode == REPLAY:
+                raise CacheMissError(
+                    f"{endpoint} page {page} (per_page={per_page}) is not cached "
+                    f"for payload {canonical_payload(params)}"
+                )
+            return None
+
+    def put(self, endpoint, params, page, per_page, body):
+        """Store the raw body of a successful page."""
+        if self.mode not in (USE, RECORD):
+            return
+
+        directory = self._request_dir(endpoint, params)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            path = self._page_path(endpoint, params, page, per_page)
+            self._write(path, gzip.compress(body))
+            meta = {
+                "endpoint": endpoint,
+                "params": params,
+                "per_page": per_page,
+                "stored_at": time.time(),
+            }
+            self._write(os.path.join(directory, "meta.json"), json.dumps(meta, default=str).encode("utf-8"))
+        except OSError as e:
+            self.logger.warning(f"Could not write response cache: {str(e)}")
+
+    @staticmethod
+    def _write(path, data):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Process-wide ResponseCache, in the mode given by MARAVI_CACHE_MODE."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache()
+        return _default_cache
@@ -0,0 +1,232 @@
+import datetime
+from typing import NamedTuple
+
+import pandas as pd
+from sqlalchemy import text
+
+from src import db
+from src.logger import setup_logger
+
+logger = setup_logger(name="Schema")
+
+DEFAULT_SCHEMA = "tarpon_base"
+
+
+class TableSpec(NamedTuple):
+    primary_key: list  # Colunas da chave primária (None para tabelas sem chave natural)
+    indexes: list  # Listas de colunas, um índice por lista
+    partition_by: str = None  # Coluna de data para particionar por mês
+
+
+# Tabelas gravadas pelos jobs. As colunas e tipos vêm do primeiro DataFrame
+# gravado; aqui ficam só chaves e índices. Em tabelas particionadas a chave
+# precisa incluir a coluna de partição, e fica como índice único.
+TABLES = {
+    "operations": TableSpec(["id", "date"], [["date"]], partition_by="date"),
+    "precos": TableSpec(["id"], [["date"], ["instrument_id", "date"]]),
+    "fund_pls": TableSpec(["id"], [["date"]]),
+    "movements": TableSpec(["id"], [["request_date"]]),
+    "portfolio": TableSpec(["portfolio_id"], []),
+    "investor": TableSpec(["investor_id"], []),
+    "distributor": TableSpec(["distributor_id"], []),
+    "positions": TableSpec(None, [["date"], ["portfolio_name", "date"]], partition_by="date"),
+    "fund_portfolio": TableSpec(None, [["date"], ["portfolio_name", "date"]], partition_by="date"),
+}
+
+
+def _quoted(columns):
+    return ", ".join(f'"{col}"' for col in columns)
+
+
+def index_name(table_name, columns):
+    return f"{table_name}_{'_'.join(columns)}_idx"[:63]
+
+
+def migrations(table_name, schema=DEFAULT_SCHEMA):
+    """(nome, [SQL]) das migrações de chave e índices de uma tabela conhecida."""
+    from src import partitions
+
+    spec = TABLES[table_name]
+    target = f'"{schema}"."{table_name}"'
+    steps = []
+    # A conversão em particionada cria uma tabela nova, sem os índices da
+    # antiga: as suas migrações têm nomes próprios para rodarem de novo
+    prefix = table_name
+    if spec.partition_by and partitions.is_partitioned(table_name, schema):
+        prefix = f"{table_name}@partitioned"
+
+    if spec.primary_key and spec.partition_by:
+        # Tabelas particionadas não aceitam PRIMARY KEY USING INDEX
+        unique = db.unique_index_name(table_name, spec.primary_key)
+        steps.append((
+            f"{prefix}:unique_key",
+            [f'CREATE UNIQUE INDEX IF NOT EXISTS "{unique}" ON {target} ({_quoted(spec.primary_key)})'],
+        ))
+    elif spec.primary_key:
+        unique = db.unique_index_name(table_name, spec.primary_key)
+        steps.append((
+            f"{table_name}:primary_key",
+            [
+                f'CREATE UNIQUE INDEX IF NOT EXISTS "{unique}" ON {target} ({_quoted(spec.primary_key)})',
+                # A constraint leva o nome do índice, que upsert_to_db continua achando
+                f'ALTER TABLE {target} ADD CONSTRAINT "{unique}" PRIMARY KEY USING INDEX "{unique}"',
+            ],
+        ))
+        # Bases migradas quando a constraint se chamava {tabela}_pkey: o índice
+        # foi renomeado e upsert_to_db criou outro, redundante, com o nome antigo
+        steps.append((
+            f"{table_name}:primary_key_name",
+            [
+                f"""DO $$ BEGIN
+                    IF EXISTS (
+                        SELECT 1 FROM pg_constraint
+                        WHERE conrelid = '{target}'::regclass AND conname = '{table_name}_pkey'
+                    ) THEN
+                        DROP INDEX IF EXISTS "{schema}"."{unique}";
+                        ALTER TABLE {target} RENAME CONSTRAINT "{table_name}_pkey" TO "{unique}";
+                    END IF;
+                END $$"""
+            ],
+        ))
+
+    for columns in spec.indexes:
+        name = index_name(table_name, columns)
+        steps.append((
+            f"{prefix}:{name}",
+            [f'CREATE INDEX IF NOT EXISTS "{name}" ON {target} ({_quoted(columns)})'],
+        ))
+    return steps
+
+
+def _ensure_migrations_table(conn, schema):
+    conn.execute(text(
+        f'CREATE TABLE IF NOT EXISTS "{schema}".schema_migrations ('
+        "name TEXT PRIMARY KEY, "
+        "applied_at TIMESTAMP NOT NULL DEFAULT now())"
+    ))
+
+
+def _applied(schema):
+    with db.get_engine().begin() as conn:
+        _ensure_migrations_table(conn, schema)
+        rows = conn.execute(text(f'SELECT name FROM "{schema}".schema_migrations'))
+        return {row[0] for row in rows}
+
+
+def apply_migrations(table_name, schema=DEFAULT_SCHEMA):
+    """
+    Aplica à tabela as migrações ainda não registradas em schema_migrations.
+
+    Cada migração roda na sua própria transação; uma que falha (por
+    exemplo, chave primária numa tabela com ids duplicados) é registrada
+    no log e tentada de novo na próxima execução.
+    """
+    if table_name not in TABLES:
+        return
+
+    applied = _applied(schema)
+    for name, statements in migrations(table_name, schema):
+        if name in applied:
+            continue
+        try:
+            with db.get_engine().begin() as conn:
+                for statement in statements:
+                    conn.execute(text(statement))
+                conn.execute(
+                    text(f'INSERT INTO "{schema}".schema_migrations (name) VALUES (:name)'),
+                    {"name": name},
+                )
+            logger.info(f"Migração {name} aplicada em {schema}")
+        except Exception as e:
+            logger.warning(f"Migração {name} não aplicada em {schema}: {e}")
+
+
+def migrate(schema=DEFAULT_SCHEMA, partition=False):
+    """
+    Aplica as migrações a todas as tabelas conhecidas que já existem. Com
+    `partition`, converte antes as tabelas de TABLES com partition_by que
+    ainda são comuns.
+    """
+    from src import partitions
+
+    for table_name, spec in TABLES.items():
+        if not db.table_exists(table_name, schema):
+            continue
+        if partition and spec.partition_by and not partitions.is_partitioned(table_name, schema):
+            partitions.convert_to_partitioned(table_name, schema, spec.partition_by)
+        apply_migrations(table_name, schema)
+
+
+def create_table(df, table_name, schema=DEFAULT_SCHEMA):
+    """
+    Cria a tabela com as colunas e tipos de `df` (como o to_sql faria) e
+    já com a chave primária e os índices de TABLES. Tabelas com
+    partition_by são criadas particionadas por mês.
+    """
+    from src import partitions
+
+    spec = TABLES[table_name]
+    ddl = pd.io.sql.get_schema(df, table_name, con=db.get_engine(), schema=schema)
+    with db.get_engine().begin() as conn:
+        if spec.partition_by:
+            conn.execute(text(f'{ddl.rstrip()} PARTITION BY RANGE ("{spec.partition_by}")'))
+            partitions.create_default_partition(conn, table_name, schema, spec.partition_by)
+        else:
+            conn.execute(text(ddl))
+    logger.info(f"Tabela {schema}.{table_name} criada")
+    apply_migrations(table_name, schema)
+
+
+def prepare_table(df, table_name, schema=DEFAULT_SCHEMA):
+    """
+    Deixa a tabela pronta para receber `df`: cria-a se não existe e, se é
+    particionada, cria as partições dos meses de `df`.
+    """
+    from src import partitions
+
+    spec = TABLES.get(table_name)
+    if spec is None:
+        return
+    if not db.table_exists(table_name, schema):
+        create_table(df, table_name, schema)
+    if (
+        spec.partition_by
+        and spec.partition_by in df.columns
+        and partitions.is_partitioned(table_name, schema)
+    ):
+        partitions.ensure_partitions(table_name, schema, df[spec.partition_by])
+
+
+def replace_dates(df, table_name, schema=DEFAULT_SCHEMA):
+    """
+    Regrava as datas de `df` trocando as partições dos seus meses (ver
+    src.partitions.replace_dates). Retorna None se a tabela não é
+    particionada, para o chamador seguir com a gravação incremental.
+    """
+    from src import partitions
+
+    spec = TABLES.get(table_name)
+    if (
+        spec is None
+        or not spec.partition_by
+        or not db.table_exists(table_name, schema)
+        or not partitions.is_partitioned(table_name, schema)
+    ):
+        return None
+    return partitions.replace_dates(df, table_name, schema, spec.partition_by)
+
+
+def date_predicate(column, dates):
+    """
+    Filtro SQL para as linhas cujo `column` cai em algum dos dias `dates`,
+    escrito como intervalos [dia, dia + 1) para poder usar o índice da
+    coluna (ao contrário de `column::date = ...`).
+    """
+    days = sorted({pd.Timestamp(d).date() for d in dates})
+    if not days:
+        return "FALSE"
+    ranges = [
+        f"(\"{column}\" >= '{day:%Y-%m-%d}' AND \"{column}\" < '{day + datetime.timedelta(days=1):%Y-%m-%d}')"
+        for day in days
+    ]
+    return "(" + " OR ".join(ranges) + ")"
@@ -0,0 +1,194 @@
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+
+import requests
+
+DEFAULT_RATE = 5.0  # Requests per second each endpoint starts at
+DEFAULT_MAX_RATE = 50.0
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_BASE = 0.5
+DEFAULT_BACKOFF_MAX = 60.0
+DEFAULT_CIRCUIT_THRESHOLD = 5
+DEFAULT_CIRCUIT_RESET = 30.0
+
+# Responses worth retrying; anything else is returned to the caller as is
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+RETRY_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+class TransientAPIError(Exception):
+    """A request kept failing with retryable errors after every retry."""
+
+
+class CircuitOpenError(TransientAPIError):
+    """The endpoint failed repeatedly and requests to it are paused."""
+
+
+def retry_after_seconds(response):
+    """Seconds asked for by a Retry-After header (delta or HTTP date), or None."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def backoff_delay(attempt, base=DEFAULT_BACKOFF_BASE, cap=DEFAULT_BACKOFF_MAX):
+    """Exponential backoff with full jitter for the given retry attempt (0-based)."""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+class TokenBucket:
+    """
+    Token bucket whose rate adapts to the server (AIMD).
+
+    Each success adds `increase` requests/s up to `max_rate`; a 429 halves
+    the rate. Waiting happens with asyncio.sleep, and the state is guarded
+    by a thread lock since clients on different event loops share a bucket.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, max_rate=DEFAULT_MAX_RATE, min_rate=0.2, increase=0.05):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """Take a token and return how long to wait before using it."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+            self.capacity = max(1.0, self.rate)
+
+    def on_throttle(self):
+        with self._lock:
+            now = time.monotonic()
+            # Requests already in flight answer 429 together; halve once per burst
+            if now - self._last_decrease < 1.0 / self.rate:
+                return
+            self._refill(now)
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.capacity = max(1.0, self.rate)
+            self.tokens = min(self.tokens, 0.0)
+
+
+class CircuitBreaker:
+    """
+    Stops calling an endpoint after `threshold` consecutive failures.
+
+    Once `reset_timeout` seconds have passed a single probe request is let
+    through: success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, threshold=DEFAULT_CIRCUIT_THRESHOLD, reset_timeout=DEFAULT_CIRCUIT_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def check(self, name=""):
+        """
+        Raise CircuitOpenError unless a request may be sent now. Returns True
+        when the request is the half-open probe; its caller must then end it
+        with record_success, record_failure or abandon_probe.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining <= 0 and not self._probing:
+                self._probing = True
+                return True
+        raise CircuitOpenError(
+            f"Circuit open for {name or 'endpoint'} after {self.failures} consecutive failures"
+        )
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+    def abandon_probe(self):
+        """
+        End a probe that got no verdict (cancelled, or an unexpected error):
+        the circuit opens again for another `reset_timeout` instead of
+        staying half-open with nobody allowed to probe.
+        """
+        with self._lock:
+            if self._probing:
+                self._probing = False
+                self.opened_at = time.monotonic()
+
+
+_limiters = {}
+_breakers = {}
+_registry_lock = threading.Lock()
+
+
+def get_rate_limiter(endpoint):
+    """Process-wide token bucket for `endpoint` (starting rate from MARAVI_RATE_LIMIT)."""
+    with _registry_lock:
+        limiter = _limiters.get(endpoint)
+        if limiter is None:
+            limiter = TokenBucket(
+                rate=float(os.getenv("MARAVI_RATE_LIMIT", DEFAULT_RATE)),
+                max_rate=float(os.getenv("MARAVI_MAX_RATE", DEFAULT_MAX_RATE)),
+            )
+            _limiters[endpoint] = limiter
+        return limiter
+
+
+def get_circuit_breaker(endpoint):
+    """Process-wide circuit breaker for `endpoint`."""
+    with _registry_lock:
+        breaker = _breakers.get(endpoint)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                threshold=int(os.getenv("MARAVI_CIRCUIT_THRESHOLD", DEFAULT_CIRCUIT_THRESHOLD)),
+                reset_timeout=float(os.getenv("MARAVI_CIRCUIT_RESET", DEFAULT_CIRCUIT_RESET)),
+            )
+            _breakers[endpoint] = breaker
+        return breaker
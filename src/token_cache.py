@@ -0,0 +1,161 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_TOKEN_TTL = 3600  # Used when the token carries no expiry information
+DEFAULT_REFRESH_MARGIN = 120  # Refresh tokens this many seconds before expiry
+LOCK_STALE_AFTER = 60
+LOCK_POLL_INTERVAL = 0.05
+
+
+def default_cache_dir():
+    basedir = os.path.abspath(os.path.dirname(__file__))
+    # An empty MARAVI_CACHE_DIR (e.g. exported from .env.example) means the default
+    return os.getenv("MARAVI_CACHE_DIR") or os.path.join(basedir, "..", ".cache")
+
+
+def _token_expiry(token, default_ttl):
+    """Epoch seconds at which `token` expires, from expires_in, the JWT exp claim or a default TTL."""
+    now = time.time()
+    if token.get("expires_in"):
+        return now + float(token["expires_in"])
+
+    parts = token.get("access_token", "").split(".")
+    if len(parts) == 3:
+        try:
+            payload = parts[1] + "=" * (-len(parts[1]) % 4)
+            claims = json.loads(base64.urlsafe_b64decode(payload))
+            if "exp" in claims:
+                return float(claims["exp"])
+        except (ValueError, TypeError):
+            pass
+
+    return now + default_ttl
+
+
+@contextmanager
+def _file_lock(path):
+    """Cross-process lock based on exclusive creation of `path`."""
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > LOCK_STALE_AFTER:
+                    os.remove(path)  # Left behind by a crashed process
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(LOCK_POLL_INTERVAL)
+    try:
+        os.close(fd)
+        yield
+    finally:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class TokenCache:
+    """
+    Maravi access tokens cached in process and on disk.
+
+    Tokens are keyed by username and client id and are treated as expired
+    `refresh_margin` seconds before their real expiry, so every worker and
+    every run() in a backfill shares a single token until it is about to lapse.
+    """
+
+    def __init__(self, path=None, refresh_margin=None, default_ttl=None):
+        self.path = path or os.getenv(
+            "MARAVI_TOKEN_CACHE", os.path.join(default_cache_dir(), "maravi_tokens.json")
+        )
+        self.refresh_margin = refresh_margin or float(
+            os.getenv("MARAVI_TOKEN_REFRESH_MARGIN", DEFAULT_REFRESH_MARGIN)
+        )
+        self.default_ttl = default_ttl or float(
+            os.getenv("MARAVI_TOKEN_TTL", DEFAULT_TOKEN_TTL)
+        )
+        self.logger = logging.getLogger("MaraviAPI")
+        self._tokens = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def key(username, client_id):
+        return hashlib.sha256(f"{username}|{client_id}".encode()).hexdigest()[:32]
+
+    def _is_fresh(self, token):
+        return token is not None and token["expires_at"] - self.refresh_margin > time.time()
+
+    def _read_disk(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_disk(self, tokens):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(tokens, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key):
+        """Return a cached token that is not about to expire, or None."""
+        with self._lock:
+            token = self._tokens.get(key)
+            if self._is_fresh(token):
+                return token
+
+            token = self._read_disk().get(key)
+            if self._is_fresh(token):
+                self._tokens[key] = token
+                return token
+        return None
+
+    def put(self, key, token_json_response):
+        token = {
+            "token_type": token_json_response["token_type"],
+            "access_token": token_json_response["access_token"],
+            "expires_at": _token_expiry(token_json_response, self.default_ttl),
+        }
+        with self._lock:
+            self._tokens[key] = token
+            tokens = {
+                k: v for k, v in self._read_disk().items() if v["expires_at"] > time.time()
+            }
+            tokens[key] = token
+            try:
+                self._write_disk(tokens)
+            except OSError as e:
+                self.logger.warning(f"Could not persist token cache: {str(e)}")
+        return token
+
+    @contextmanager
+    def lock(self):
+        """Serialize refreshes across threads and processes."""
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with _file_lock(f"{self.path}.lock"):
+                yield
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_token_cache():
+    """Process-wide TokenCache shared by every Maravi client."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = TokenCache()
+        return _default_cache
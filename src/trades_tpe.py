@@ -1,17 +1,51 @@
-import os
 import datetime
+import time
 import pandas as pd
 
+from src import gaps, ledger
 from src.api3 import MaraviAPI
-from src.calendar import TarponCalendar
+from src.calendar import get_calendar
+from src.decoding import DATETIME, INT64, NUMERIC, OBJECT
 from src.logger import setup_logger
+from src.maravi import get_client
 from src.db import append_to_db, get_data_from_db, table_exists
-import time
+from src.pipeline import prefetch
+from src.planner import run_planned
+from src.schema import date_predicate
 
 
 logger = setup_logger(name="Trades TPE")
 
-tarpon_calendar = TarponCalendar()
+JOB = "operations"
+TABLE = "operations"
+OPERATIONS_ENDPOINT = "operations/operations/get"
+
+# Colunas mantidas de cada operação e seus tipos; os demais campos da API são descartados
+OPERATION_SCHEMA = {
+    "id": OBJECT,
+    "origin_id": INT64,
+    "portfolio_id": INT64,
+    "portfolio_name": OBJECT,
+    "instrument_id": INT64,
+    "date": DATETIME,
+    "cash_settlement_date": DATETIME,
+    "quantity": NUMERIC,
+    "instrument_symbol": OBJECT,
+    "side_name": OBJECT,
+    "unit_value": NUMERIC,
+    "brokerage_fee_gross_value": NUMERIC,
+    "total_financial_net": NUMERIC,
+    "executing_brokerage_fee_value": NUMERIC,
+    "brokerage_fee_net_value": NUMERIC,
+    "carrying_brokerage_fee_value": NUMERIC,
+    "brokerage_rebate_value": NUMERIC,
+    "total_emoluments_value": NUMERIC,
+    "emoluments_value": NUMERIC,
+    "settlement_fee_value": NUMERIC,
+    "book_name": OBJECT,
+    "broker_name": OBJECT,
+    "rebate_percent": NUMERIC,
+}
 
 
 def append_entity_data(df, entity_type, id_column, data, schema="tarpon_base"):
@@ -33,18 +67,18 @@ def append_entity_data(df, entity_type, id_column, data, schema="tarpon_base"):
 
     logger.info(f"Verificando {len(df)} registros da API contra a base...")
     
-    # Buscar apenas IDs da data específica (muito mais rápido)
+    # Buscar apenas IDs da data específica (intervalo que usa o índice de date)
     date_str = data.strftime('%Y-%m-%d')
     existing_ids_query = f"""
     SELECT DISTINCT {id_column} 
     FROM {schema}.{table_name} 
-    WHERE date::date = '{date_str}' 
+    WHERE {date_predicate("date", [data])}
     AND {id_column} IS NOT NULL
     """
     
     try:
-        from src.db import engine
-        existing_ids_df = pd.read_sql(existing_ids_query, engine)
+        from src.db import get_engine
+        existing_ids_df = pd.read_sql(existing_ids_query, get_engine())
         existing_ids = existing_ids_df[id_column].astype(str).tolist() if not existing_ids_df.empty else []
         logger.info(f"Encontrados {len(existing_ids)} IDs já existentes na base para {date_str}")
     except Exception as e:
@@ -73,110 +107,114 @@ def append_entity_data(df, entity_type, id_column, data, schema="tarpon_base"):
         logger.info("Nenhum registro novo para inserir")
 
 
-def batch():
-    datas = tarpon_calendar.get_business_days_in_range(datetime.date(2020, 1, 1), datetime.date(2025, 8, 26))
-    for data in datas:
-        try:
-            run(data)
-            time.sleep(1)  # Pausa entre requisições
-        except Exception as e:
-            logger.error(f"Erro para data {data}: {e}")
-            continue
-
-def run(data=None):
-    logger.info("Executando o script de operações...")
-
-    if data is None:
-        data = tarpon_calendar.get_previous_trading_day(datetime.date.today())
-
-    logger.info("Buscando dados para: %s", data)
-
-    MARAVI_USER = os.getenv("MARAVI_USER")
-    MARAVI_PASS = os.getenv("MARAVI_PASS")
-    MARAVI_CLIENT_ID = os.getenv("MARAVI_CLIENT_ID")
-    MARAVI_CLIENT_SECRET = os.getenv("MARAVI_CLIENT_SECRET")
+def batch(start=None, end=None, force=False):
+    """
+    Backfill de `start` a `end` (por padrão, da primeira data gravada até o
+    último dia útil) que busca só as datas faltando ou incompletas.
+    """
+    datas = gaps.expected_dates(TABLE, "date", start, end)
+    pendentes = gaps.plan_gaps(
+        JOB, TABLE, "date", datas, day_payload,
+        force=force,
+    )
+    if not pendentes:
+        logger.info("Nenhuma data faltando")
+        return
 
+    m = connect()
+    run_planned(
+        pendentes,
+        OPERATIONS_ENDPOINT,
+        fetch=lambda start, end: fetch_operations(m, start, end),
+        load=load_operations,
+        transform=transform_operations,
+        date_column="date",
+        business_days=datas,
+        job=JOB,
+        payload=day_payload,
+        force=True,  # plan_gaps já consultou o run_ledger
+    )
+
+
+def connect():
     logger.info("Conectando na API...")
-    m = MaraviAPI(MARAVI_USER, MARAVI_PASS, MARAVI_CLIENT_ID, MARAVI_CLIENT_SECRET)
-    m.authenticate()
+    m = get_client(MaraviAPI)
     logger.info("Autenticado com sucesso!")
+    return m
+
 
-    payload = {
-        "start_date": data.strftime("%Y-%m-%d"),
-        "end_date": data.strftime("%Y-%m-%d"),
+def build_payload(start, end):
+    return {
+        "start_date": start.strftime("%Y-%m-%d"),
+        "end_date": end.strftime("%Y-%m-%d"),
         "sides": [6, 7, 8, 4, 3, 1, 2, 5],
         #"operation_types": [1, 14],
         "instrument_group_ids": [8,11],
     }
-    
-    logger.info("Buscando dados na API...")
-    df = m.fetch_data("operations/operations/get", payload)
-    logger.info("Dados obtidos com sucesso!")
 
-    if df.empty:
-        logger.info(f"Nenhum dado de operação encontrado para a data: {data}")
-        return
 
-    desired_columns = [
-        "id",
-        "origin_id", 
-        "portfolio_id",
-        "portfolio_name", 
-        "instrument_id", 
-        "date", 
-        "cash_settlement_date", 
-        "quantity", 
-        "instrument_symbol", 
-        "side_name", 
-        "unit_value", 
-        "brokerage_fee_gross_value",
-        "total_financial_net",
-        "executing_brokerage_fee_value",
-        "brokerage_fee_net_value",
-        "carrying_brokerage_fee_value",
-        "brokerage_rebate_value",
-        "total_emoluments_value",
-        "emoluments_value",
-        "settlement_fee_value",
-        "book_name", 
-        "broker_name",
-        "rebate_percent"
+def day_payload(data):
+    """Payload da requisição de um dia; identifica a unidade no run_ledger."""
+    return build_payload(data, data)
+
+
+def fetch_operations(m, start, end):
+    """Busca todas as operações entre `start` e `end` num único DataFrame."""
+    batches = [
+        df
+        for df in m.iter_batches(OPERATIONS_ENDPOINT, build_payload(start, end), schema=OPERATION_SCHEMA)
+        if not df.empty
     ]
-    
-    available_columns = [col for col in desired_columns if col in df.columns]
-    missing_columns = [col for col in desired_columns if col not in df.columns]
-    
+    return pd.concat(batches, ignore_index=True) if batches else pd.DataFrame()
+
+
+def transform_operations(df):
+    """Operações com id, nas colunas de OPERATION_SCHEMA que vieram da API."""
+    available_columns = [col for col in OPERATION_SCHEMA if col in df.columns]
+    missing_columns = [col for col in OPERATION_SCHEMA if col not in df.columns]
+
     if missing_columns:
         logger.warning(f"Colunas ausentes no DataFrame: {missing_columns}")
         logger.info("Colunas disponíveis que serão utilizadas: " + ", ".join(available_columns))
-    
-    df = df[available_columns].copy()
-    
-    # Convert numeric columns
-    numeric_columns = [
-        "quantity", "unit_value", "brokerage_fee_gross_value", "total_financial_net",
-        "executing_brokerage_fee_value", "brokerage_fee_net_value", "carrying_brokerage_fee_value",
-        "brokerage_rebate_value", "total_emoluments_value", "emoluments_value", 
-        "settlement_fee_value", "rebate_percent"
-    ]
-    
-    existing_numeric_columns = [col for col in numeric_columns if col in df.columns]
-    for col in existing_numeric_columns:
-        df[col] = pd.to_numeric(df[col], errors="coerce")
-
-    # Convert date columns  
-    date_columns = ["date", "cash_settlement_date"]
-    existing_date_columns = [col for col in date_columns if col in df.columns]
-    for col in existing_date_columns:
-        df[col] = pd.to_datetime(df[col], errors="coerce")
-
-    # Convert ID columns to Int64
-    id_columns = ["portfolio_id", "instrument_id", "origin_id"]
-    existing_id_columns = [col for col in id_columns if col in df.columns]
-    for col in existing_id_columns:
-        df[col] = df[col].astype("Int64")
 
+    return df[df["id"].notnull()].copy()
+
+
+def load_operations(df, data):
+    """Grava um lote de operações da data `data`."""
     # Para operações - passa a data como parâmetro
-    df_operations = df[df["id"].notnull()].copy()
-    append_entity_data(df_operations, "operations", "id", data)
+    append_entity_data(df, "operations", "id", data)
+
+
+def run(data=None, force=False):
+    logger.info("Executando o script de operações...")
+
+    if data is None:
+        data = get_calendar().get_previous_trading_day(datetime.date.today())
+
+    logger.info("Buscando dados para: %s", data)
+
+    if ledger.is_done(JOB, data, day_payload, force):
+        logger.info(f"{JOB} de {data:%Y-%m-%d} já concluído no run_ledger; use --force para refazer")
+        return
+    started = time.perf_counter()
+
+    m = connect()
+
+    logger.info("Buscando dados na API...")
+    total_records = 0
+    # A próxima página é buscada enquanto a atual é gravada
+    for df in prefetch(m.iter_batches(OPERATIONS_ENDPOINT, build_payload(data, data), schema=OPERATION_SCHEMA)):
+        if df.empty:
+            continue
+        total_records += len(df)
+        logger.info(f"Processando lote de {len(df)} operações...")
+        load_operations(transform_operations(df), data)
+
+    if total_records == 0:
+        logger.info(f"Nenhum dado de operação encontrado para a data: {data}")
+        ledger.record(JOB, data, 0, day_payload, time.perf_counter() - started)
+        return
 
+    logger.info(f"Dados obtidos com sucesso! Total de operações: {total_records}")
+    ledger.record(JOB, data, total_records, day_payload, time.perf_counter() - started)